@@ -0,0 +1,129 @@
+import hashlib, json, os, pickle, re, sqlite3, threading, time
+
+CACHE_DIR = "_temp/cache"
+HASH_BLOCK_SIZE = 1024 * 1024
+RESPONSE_CACHE_FILE = "responses.sqlite"
+RESPONSE_CACHE_MAX_SIZE = 256 * 1024 * 1024
+RESPONSE_CACHE_VERSION = 1
+
+RESPONSE_CACHE_SCHEMA = """
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = NORMAL;
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    translation TEXT NOT NULL,
+    tags TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+"""
+
+def file_digest(file_path: str):
+    "Returns the hex digest of the content of a file."
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        while block := f.read(HASH_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+def cache_file_name(kind: str, digest: str, source_language: str, target_language: str, version: int):
+    languages = "_".join(re.sub(r"[^\w-]", "-", language) for language in (source_language, target_language))
+    return f"{kind}_{digest}_{languages}_v{version}.pickle"
+
+def cached_build(kind: str, file_path: str, source_language: str, target_language: str, version: int, build, directory: str = CACHE_DIR):
+    """Loads a compiled translation memory or termbase from the cache, or builds and caches it.
+    The cache key is the content hash of file_path + source/target language + loader version,
+    so an edited file, another language pair or a changed loader never reuses an old artifact.
+    build -> Function without arguments that builds the artifact on a cache miss.
+    Returns the artifact.
+    """
+    os.makedirs(directory, exist_ok=True)
+    cache_path = os.path.join(directory, cache_file_name(kind, file_digest(file_path), source_language, target_language, version))
+
+    if os.path.exists(cache_path):
+        start_time = time.perf_counter()
+        try:
+            with open(cache_path, "rb") as f:
+                artifact = pickle.load(f)
+            print(f"Loaded cached {kind} for {os.path.basename(file_path)} in {time.perf_counter() - start_time:.1f}s")
+            return artifact
+        except Exception as e:
+            print(f"Cache file {cache_path} could not be loaded, rebuilding: {e}")
+
+    artifact = build()
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            pickle.dump(artifact, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        print(f"Could not write cache file {cache_path}: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return artifact
+
+def response_key(*inputs):
+    """Returns the content hash of the inputs of an engine request
+    (engine and model, languages, masked source, TM target, glossary, context...).
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(json.dumps([RESPONSE_CACHE_VERSION, *inputs], ensure_ascii=False).encode("utf-8"))
+    return digest.hexdigest()
+
+class ResponseCache:
+    """Engine translations stored in a SQLite file, shared by every job, so a re-run doesn't pay the engines again.
+    The key is a content hash of the request inputs (response_key). The tags of the source are stored with the
+    translation, a hit is adapted to the tags of the segment like a repetition (transfer_tags).
+    The file is kept under max_size, the least recently used responses are removed first.
+    """
+
+    def __init__(self, db_path: str, max_size: int = RESPONSE_CACHE_MAX_SIZE):
+        self.db_path = db_path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.executescript(RESPONSE_CACHE_SCHEMA)
+        self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @classmethod
+    def open(cls, directory: str = CACHE_DIR, max_size: int = RESPONSE_CACHE_MAX_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        return cls(os.path.join(directory, RESPONSE_CACHE_FILE), max_size)
+
+    def get(self, key: str):
+        "Returns the cached (translation, source tags dictionary) of a key and marks it as recently used, or None."
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT translation, tags FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        return row[0], json.loads(row[1])
+
+    def put(self, key: str, translation: str, tags_dict: dict):
+        "Stores the translation of a key, then removes the least recently used responses above max_size."
+        tags = json.dumps(tags_dict, ensure_ascii=False)
+        size = len(key) + len(translation.encode("utf-8")) + len(tags.encode("utf-8"))
+        with self.lock, self.connection:
+            previous = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, translation, tags, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, translation, tags, size, time.time()),
+            )
+            self.size += size - (previous[0] if previous else 0)
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        "Removes the least recently used responses until the cache is under 90% of max_size."
+        removed_keys = []
+        for key, size in self.connection.execute("SELECT key, size FROM responses ORDER BY last_used"):
+            if self.size <= self.max_size * 0.9:
+                break
+            removed_keys.append((key,))
+            self.size -= size
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", removed_keys)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,373 @@
+import asyncio, contextlib, contextvars, httpx, re, time, variables
+from collections import Counter, deque
+from metering import meter, percentile
+
+RATE_MIN = 0.2
+RATE_WINDOW = 10
+RATE_DEFAULT_PAUSE = 1.0
+HEDGE_PERCENTILE = 95
+HEDGE_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY = 1.0
+HEDGE_THROTTLE_PAUSE = 60
+DURATION_REGEX = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+# set within rate_limit, the next HTTP request already has its turn
+rate_limit_granted = contextvars.ContextVar("rate_limit_granted", default=False)
+
+def connection_limits(max_in_flight: int):
+    "Returns the connection pool limits of an engine HTTP client, one keep-alive connection per in-flight request."
+    return httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight)
+
+def parse_duration(value: str):
+    "Returns the seconds of a rate limit reset header (\"20ms\", \"1.5s\", \"6m0s\", or plain seconds)."
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    parts = DURATION_REGEX.findall(value or "")
+    if not parts:
+        return None
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+class RateLimiter:
+    """Adaptive token bucket of one engine, shared by every worker of the run.
+    Requests queue in order and leave at the current rate (requests per second) and, when the engine reports
+    one, within the tokens per minute. Without a known limit requests are not delayed until the first 429.
+    A 429 pauses the whole queue (Retry-After or reset headers) and halves the rate, every accepted request
+    raises it again a little (additive increase), up to the limits of the x-ratelimit-* headers.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = asyncio.Lock()
+        self.rate = None
+        self.max_rate = None
+        self.next_request = 0.0
+        self.paused_until = 0.0
+        self.tokens_per_minute = None
+        self.token_level = 0.0
+        self.token_time = time.monotonic()
+        self.sent = deque()
+        self.throttled = 0
+        self.last_throttled = None
+
+    async def acquire(self, tokens: int = 0):
+        "Waits for the turn of a request, in order of arrival."
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.refill_tokens(now)
+                ready = max(self.paused_until, self.next_request, self.token_ready(tokens, now))
+                if ready <= now:
+                    break
+                await asyncio.sleep(ready - now)
+            self.next_request = now + 1 / self.rate if self.rate else now
+            if self.tokens_per_minute:
+                self.token_level -= min(tokens, self.tokens_per_minute)
+            self.sent.append(now)
+            while self.sent and self.sent[0] < now - RATE_WINDOW:
+                self.sent.popleft()
+
+    def refill_tokens(self, now: float):
+        if self.tokens_per_minute:
+            self.token_level = min(self.tokens_per_minute, self.token_level + (now - self.token_time) * self.tokens_per_minute / 60)
+        self.token_time = now
+
+    def token_ready(self, tokens: int, now: float):
+        if not self.tokens_per_minute:
+            return now
+        missing = min(tokens, self.tokens_per_minute) - self.token_level
+        return now if missing <= 0 else now + missing * 60 / self.tokens_per_minute
+
+    def observed_rate(self):
+        "Requests per second sent over the last RATE_WINDOW seconds."
+        if len(self.sent) < 2:
+            return RATE_MIN
+        return len(self.sent) / max(self.sent[-1] - self.sent[0], 1)
+
+    def on_response(self, status_code: int, headers):
+        "Adapts the rate to a response of the engine."
+        self.read_limit_headers(headers)
+        if status_code == 429:
+            self.throttle(headers)
+        elif status_code < 400 and self.rate is not None:
+            self.rate += 1 / self.rate
+            if self.max_rate is not None:
+                self.rate = min(self.rate, self.max_rate)
+
+    def throttle(self, headers):
+        now = time.monotonic()
+        pause = None
+        if "retry-after-ms" in headers:
+            pause = parse_duration(headers["retry-after-ms"] + "ms")
+        elif "retry-after" in headers:
+            pause = parse_duration(headers["retry-after"])
+        if pause is None:
+            pause = parse_duration(headers.get("x-ratelimit-reset-requests")) or RATE_DEFAULT_PAUSE
+        self.throttled += 1
+        self.last_throttled = now
+        if now >= self.paused_until:
+            self.rate = max(RATE_MIN, min(self.rate or self.observed_rate(), self.observed_rate()) / 2)
+            print(f"{self.name} is rate limited, continuing at {self.rate:.1f} requests/s in {pause:.1f}s")
+        self.paused_until = max(self.paused_until, now + pause)
+
+    def read_limit_headers(self, headers):
+        "Reads the x-ratelimit-* headers (OpenAI style: limits per minute, remaining and reset)."
+        limit_requests = headers.get("x-ratelimit-limit-requests")
+        if limit_requests and limit_requests.isdigit():
+            self.max_rate = int(limit_requests) / 60
+            if self.rate is None or self.rate > self.max_rate:
+                self.rate = self.max_rate
+        limit_tokens = headers.get("x-ratelimit-limit-tokens")
+        if limit_tokens and limit_tokens.isdigit():
+            if self.tokens_per_minute is None:
+                self.token_level = int(limit_tokens)
+            self.tokens_per_minute = int(limit_tokens)
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if self.tokens_per_minute and remaining_tokens and remaining_tokens.isdigit():
+            self.refill_tokens(time.monotonic())
+            self.token_level = min(self.token_level, int(remaining_tokens))
+
+    async def wait(self, tokens: int = 0):
+        "Waits for the turn of a request (acquire), the wait is metered."
+        started = time.monotonic()
+        await self.acquire(tokens if self.tokens_per_minute else 0)
+        meter().count(self.name, rate_limit_wait_seconds=time.monotonic() - started)
+
+    async def request_hook(self, request):
+        """httpx request event hook for the requests that didn't get their turn before they were sent (rate_limit),
+        like the retries of an engine library. The estimated tokens of a request are a quarter of its body.
+        """
+        if rate_limit_granted.get():
+            rate_limit_granted.set(False)
+            return
+        await self.wait(len(request.content) // 4)
+
+    async def response_hook(self, response):
+        self.on_response(response.status_code, response.headers)
+        if response.status_code == 429:
+            meter().count(self.name, throttled=1)
+
+class Hedger:
+    """Sends a duplicate of an engine request that is slower than the engine's recent latency percentile
+    (HEDGE_PERCENTILE of the last HEDGE_WINDOW metered requests) and keeps the first successful response, the other one is cancelled.
+    budget -> Maximum duplicates in percent of the requests of an engine, the extra spend of a run.
+    No duplicates are sent before HEDGE_MIN_SAMPLES requests, or within HEDGE_THROTTLE_PAUSE seconds of a 429.
+    """
+
+    def __init__(self, budget: float, rate_limiters: dict):
+        self.budget = budget
+        self.rate_limiters = rate_limiters
+        self.requests = Counter()
+        self.hedges = Counter()
+        self.delays = {}
+
+    def delay(self, engine: str):
+        "Returns the hedge delay of an engine, recomputed every 10 requests, or None without enough samples."
+        if self.requests[engine] % 10 == 1 or engine not in self.delays:
+            latencies = sorted(meter().usage(engine).latencies[-HEDGE_WINDOW:])
+            if len(latencies) < HEDGE_MIN_SAMPLES:
+                self.delays[engine] = None
+            else:
+                self.delays[engine] = max(HEDGE_MIN_DELAY, percentile(latencies, HEDGE_PERCENTILE))
+        return self.delays[engine]
+
+    def may_hedge(self, engine: str):
+        rate_limiter = self.rate_limiters.get(engine)
+        if rate_limiter is not None and rate_limiter.last_throttled is not None and time.monotonic() - rate_limiter.last_throttled < HEDGE_THROTTLE_PAUSE:
+            return False
+        return self.hedges[engine] + 1 <= self.requests[engine] * self.budget / 100
+
+    def record_cancelled(self, engine: str, primary_cancelled: bool, backup_sent: bool, sent_time: float):
+        """Meters the request that lost the race and is cancelled, it was sent (and may be billed) too.
+        A cancelled primary is the slow tail: its time so far is kept in the latency samples, otherwise every hedge
+        would drop a slow request from the window and lower the next hedge delay.
+        """
+        if primary_cancelled:
+            meter().request(engine, time.monotonic() - sent_time)
+        elif backup_sent:
+            meter().count(engine, requests=1)
+
+    async def run(self, engine: str, send):
+        """Returns the result of send, an async function that sends one request and sets its sent event
+        (asyncio.Event) when it's sent, after waiting for a slot. The hedge delay starts at the event.
+        """
+        self.requests[engine] += 1
+        sent = asyncio.Event()
+        primary = asyncio.ensure_future(send(sent))
+        tasks = [primary]
+        try:
+            sent_waiter = asyncio.ensure_future(sent.wait())
+            await asyncio.wait([primary, sent_waiter], return_when=asyncio.FIRST_COMPLETED)
+            sent_waiter.cancel()
+            sent_time = time.monotonic()
+            while not primary.done():
+                # the delay may only become known while waiting, once enough other requests are metered
+                delay = self.delay(engine)
+                waited = time.monotonic() - sent_time
+                if delay is not None and waited >= delay:
+                    break
+                await asyncio.wait([primary], timeout=delay - waited if delay is not None else HEDGE_MIN_DELAY)
+            if primary.done() or not self.may_hedge(engine):
+                return await primary
+
+            def send_backup():
+                self.hedges[engine] += 1
+                meter().count(engine, hedges=1)
+                backup_sent = asyncio.Event()
+                backup = asyncio.ensure_future(send(backup_sent))
+                tasks.append(backup)
+                return backup, backup_sent
+
+            backup, backup_sent = send_backup()
+            pending = {primary, backup}
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        meter().count(engine, hedge_wins=1 if task is backup else 0, hedge_losses=0 if task is backup else 1)
+                        if pending:
+                            self.record_cancelled(engine, primary_cancelled=task is backup, backup_sent=backup_sent.is_set(), sent_time=sent_time)
+                        return task.result()
+                # a failed duplicate never wins, the slow primary is hedged again while the budget allows
+                if backup in done and primary in pending and self.may_hedge(engine):
+                    backup, backup_sent = send_backup()
+                    pending.add(backup)
+                if not pending:
+                    return primary.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+class EngineRegistry:
+    """Engine clients of a run, each one is created once per configuration and shared by all workers.
+    The HTTP clients keep their connections alive, their pool follows the in-flight limit.
+    """
+
+    def __init__(self, max_in_flight: int, hedge_budget: float = 0):
+        self.limits = connection_limits(max_in_flight)
+        self.clients = {}
+        self.library_clients = []
+        self.rate_limiters = {}
+        self.hedger = Hedger(hedge_budget, self.rate_limiters) if hedge_budget > 0 else None
+
+    def client(self, key, build):
+        """Returns the client of a configuration.
+        key -> Hashable description of the configuration (engine, model, host...)
+        build -> Function without arguments that creates the client on first use.
+        """
+        client = self.clients.get(key)
+        if client is None:
+            client = self.clients[key] = build()
+        return client
+
+    def close_with_run(self, client: httpx.AsyncClient):
+        "Closes an HTTP client that an engine library created on its own (ChatOllama) together with the registry."
+        self.library_clients.append(client)
+
+    def rate_limiter(self, name: str):
+        "Returns the RateLimiter of an engine."
+        if name not in self.rate_limiters:
+            self.rate_limiters[name] = RateLimiter(name)
+        return self.rate_limiters[name]
+
+    def http_client_options(self, name: str):
+        "Returns the httpx.AsyncClient options of an engine: the connection pool and the rate limiter hooks."
+        rate_limiter = self.rate_limiter(name)
+        return {
+            "limits": self.limits,
+            "event_hooks": {"request": [rate_limiter.request_hook], "response": [rate_limiter.response_hook]},
+        }
+
+    def http_client(self, name: str, timeout: float):
+        "Returns the pooled keep-alive HTTP client of an engine, its requests go through the engine's RateLimiter."
+        return self.client(("http", name), lambda: httpx.AsyncClient(timeout=timeout, **self.http_client_options(name)))
+
+    async def aclose(self):
+        for client in self.clients.values():
+            if isinstance(client, httpx.AsyncClient):
+                await client.aclose()
+        for client in self.library_clients:
+            await client.aclose()
+        self.clients.clear()
+        self.library_clients.clear()
+
+def open_engines(max_in_flight: int):
+    """Creates the in-flight limit and the engine registry of a run, called on the run's event loop.
+    max_in_flight -> Number of engine requests (LLM or DeepL) that may wait for a response at the same time.
+    """
+    variables.trans_info["request_slots"] = asyncio.Semaphore(max_in_flight)
+    variables.trans_info["engines"] = EngineRegistry(max_in_flight, variables.hedge_budget)
+
+async def close_engines():
+    engines = variables.trans_info["engines"]
+    variables.trans_info["request_slots"] = None
+    variables.trans_info["engines"] = None
+    if engines is not None:
+        await engines.aclose()
+
+def engine_client(key, build):
+    "Returns the run's client of a configuration (EngineRegistry.client), outside of a run a new one."
+    engines = variables.trans_info["engines"]
+    if engines is None:
+        return build()
+    return engines.client(key, build)
+
+def http_client(name: str, timeout: float):
+    "Returns the run's pooled HTTP client of an engine (EngineRegistry.http_client), outside of a run a new one."
+    engines = variables.trans_info["engines"]
+    if engines is None:
+        return httpx.AsyncClient(timeout=timeout)
+    return engines.http_client(name, timeout)
+
+def http_client_options(name: str):
+    "Returns the run's httpx.AsyncClient options of an engine (EngineRegistry.http_client_options), none outside of a run."
+    engines = variables.trans_info["engines"]
+    if engines is None:
+        return {}
+    return engines.http_client_options(name)
+
+def close_with_run(client: httpx.AsyncClient):
+    "Closes a library's HTTP client at the end of the run (EngineRegistry.close_with_run), nothing outside of a run."
+    engines = variables.trans_info["engines"]
+    if engines is not None:
+        engines.close_with_run(client)
+
+async def hedged(engine: str, send):
+    """Runs one engine request, hedged by the run's Hedger when hedging is on (variables.hedge_budget).
+    send -> Async function with an asyncio.Event argument that sends the request and sets the event once it is sent.
+    """
+    engines = variables.trans_info["engines"]
+    if engines is None or engines.hedger is None:
+        return await send(asyncio.Event())
+    return await engines.hedger.run(engine, send)
+
+@contextlib.asynccontextmanager
+async def rate_limit(engine: str, tokens: int = 0):
+    """Waits for the turn of an engine request in the run's RateLimiter (async with rate_limit(engine): ...), before
+    the request counts as sent (hedged) and its latency is metered, so the queue time doesn't inflate the latency percentile.
+    The first HTTP request within the block doesn't wait again in the RateLimiter hook. No wait outside of a run.
+    tokens -> Estimated tokens of the request, for engines with a tokens per minute limit.
+    """
+    engines = variables.trans_info["engines"]
+    if engines is None:
+        yield
+        return
+    await engines.rate_limiter(engine).wait(tokens)
+    granted = rate_limit_granted.set(True)
+    try:
+        yield
+    finally:
+        rate_limit_granted.reset(granted)
+
+def request_slot():
+    """Holds one in-flight slot for the duration of an engine request (async with request_slot(): ...).
+    Retries wait outside of the slot, so a backoff never takes capacity from other requests.
+    Returns a no-op context manager outside of a run.
+    """
+    request_slots = variables.trans_info["request_slots"]
+    if request_slots is None:
+        return contextlib.nullcontext()
+    return request_slots
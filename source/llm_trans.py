@@ -2,9 +2,14 @@ from langchain_openai import ChatOpenAI
 from langchain_ollama import ChatOllama
 from pydantic import BaseModel, Field
 from typing import Optional
-import time, variables
+import asyncio, contextlib, functools, time, variables
 from segment import (restore_tags, find_tag_discrepancies, remove_discrepant_tags, create_tag_dict, 
                          is_numbered_list, is_bracketed_number, check_for_tags, check_termbase)
+from engine import close_with_run, engine_client, hedged, http_client, http_client_options, rate_limit, request_slot
+from metering import increment, meter
+from ollama_pool import ollama_host, ollama_hosts, OLLAMA_KEEP_ALIVE
+
+LLM_BATCH_TOKEN_BUDGET = 1500
 
 class TranslationRequest(BaseModel):
     translation: str
@@ -12,8 +17,29 @@ class TranslationRequest(BaseModel):
         default=..., description="Comments about translation (optional)"
     )
 
+class BatchTranslation(BaseModel):
+    id: int = Field(description="Id of the text")
+    translation: str
+
+class BatchTranslationRequest(BaseModel):
+    translations: list[BatchTranslation] = Field(
+        description="One translation for every text, with the id of the text"
+    )
+
 
-def select_llm():
+def select_llm(schema=TranslationRequest, num_predict=128, host=None):
+    """Returns the structured output LLM of the selected provider.
+    The LLM is created once per configuration and run (engine_client) and reuses its HTTP connections.
+    host -> Ollama base URL (ollama_host), the first configured host if None.
+    """
+    if variables.selected_llm == "OpenAI":
+        key = ("OpenAI", variables.openAI_model, variables.openAI_api, schema)
+    else:
+        host = host or (ollama_hosts() or [None])[0]
+        key = ("Ollama", variables.ollama_model, host, schema, num_predict)
+    return engine_client(key, lambda: create_llm(schema, num_predict, host))
+
+def create_llm(schema, num_predict, host=None):
     if variables.selected_llm == "OpenAI":
         llm = ChatOpenAI(
             model=variables.openAI_model,
@@ -22,101 +48,96 @@ def select_llm():
             timeout=30,
             api_key=variables.openAI_api,
             format="json",
+            http_async_client=http_client("OpenAI", 30),
         )
     elif variables.selected_llm == "Ollama":
         llm = ChatOllama(
         model = variables.ollama_model,
         temperature = 0.5,
-        num_predict = 128,
-        base_url = variables.ollama_host,
+        num_predict = num_predict,
+        base_url = host,
         format = "json",
+        keep_alive = OLLAMA_KEEP_ALIVE,
+        async_client_kwargs = http_client_options("Ollama"),
         )
+        # ChatOllama builds its own ollama.AsyncClient, its keep-alive connections are closed with the run
+        close_with_run(llm._async_client._client)
 
-    structured_llm = llm.with_structured_output(TranslationRequest)
+    structured_llm = llm.with_structured_output(schema, include_raw=True)
     return structured_llm
 
+async def invoke_llm(messages, schema=TranslationRequest, num_predict=128):
+    """Sends the messages to the selected LLM within an in-flight slot (request_slot) and its turn of the rate limiter
+    (rate_limit), and meters the request. Ollama requests go to the least busy host of the pool (ollama_host).
+    A slow request may be hedged (hedged).
+    Returns the parsed output and the token usage (parse_response), raises the parsing error of an invalid output.
+    """
+    async def send(sent):
+        async with request_slot():
+            async with ollama_host() if variables.selected_llm == "Ollama" else contextlib.nullcontext() as host:
+                llm = select_llm(schema, num_predict, host)
+                async with rate_limit(variables.selected_llm, sum(estimate_tokens(content) for _, content in messages)):
+                    sent.set()
+                    started = time.perf_counter()
+                    response = await llm.ainvoke(messages)
+                    meter().request(variables.selected_llm, time.perf_counter() - started)
+        # an invalid output raises inside the hedged request, so a malformed duplicate never wins the race
+        return parse_response(response)
 
-def chatGPT_translate(row):   
-    segment_from_row = row["Source"]
-    segment_context = row["Context"]
-    
-    source_text, source_tags_dict = create_tag_dict(segment_from_row)
-    
-    if variables.trans_info["source_language"] in variables.language_locale.keys():
-        source_language_name = variables.language_locale[variables.trans_info["source_language"]]
-    else:
-        source_language_name = variables.trans_info["source_language"]
-        
-    if variables.trans_info["target_language"] in variables.language_locale.keys():
-        target_language_name = variables.language_locale[variables.trans_info["target_language"]]
-    else:
-        target_language_name = variables.trans_info["target_language"]
-        
+    return await hedged(variables.selected_llm, send)
+
+
+async def chatGPT_translate(segment):
+    """Translates the segment using the selected LLM.
+    Returns translated string and translation log (the prompt).
+    """
+    return await llm_single(segment)
+
+async def chatGPT_improve_tm(segment, translation_memory):
+    """Revises the translation memory match of the segment using the selected LLM.
+    Returns translated string and translation log (the prompt).
+    """
+    return await llm_single(segment, translation_memory)
+
+async def llm_single(segment, translation_memory=None):
+    """Sends the segment in one request (PromptBuilder), retrying until the translation passes the checks.
+    The prompt and completion tokens of every attempt are added to the segment and metered.
+    """
+    source_text, source_tags_dict = segment.masked()
     if not source_text:
-        return ""
-    
-    prompt = f"Translate the following text from {source_language_name} to {target_language_name}. Respond using JSON only."
-    
-    if is_numbered_list(source_text):
-        prompt += "\nSource text starts with a numbered list, your translation must start with the same numbered list."
-        
-    if is_bracketed_number(source_text):
-        prompt += "\nSource text contains numbers in brackets, your translation must include the same numbers in same brackets in correct positions."
-        
-    relevant_glossary = {}
-    
-    if variables.trans_info["tb_df"] is not None:
-        relevant_glossary = check_termbase(source_text)     
-            
-    if len(relevant_glossary) > 0:
-        prompt += "Strictly use this termbase:\n"
-        for index, info in relevant_glossary.items():
-            source = info["Source"]
-            target = info["Target"]
-            prompt += f"- {source} = {target}.\n"    
-        
-    #prompt += "\nRespond after 'Translation:' with nothing but your translation."
-    if segment_context.strip() != "N/A" and segment_context.strip() != "":
-        prompt += f"\nAdditional info about the segment to help you translate: \n{segment_context}"
-    prompt += "\nText:"
-    prompt += f"\n{source_text}"
-    #prompt += "\nTranslation:"  
-    
-    messages = [
-        (
-            "system",
-            "You are a localization & translation expert.",
-        ),
-        ("human", prompt),
-    ]
+        return "", ""
+    target_text = create_tag_dict(translation_memory)[0] if translation_memory is not None else None
+
+    builder = prompt_builder(variables.trans_info["source_language"], variables.trans_info["target_language"])
+    messages = builder.messages(source_text, segment.context, target_text)
+    prompt = builder.log(messages)
 
     max_retries = 10
     retry_delay = 20 if variables.selected_llm == "OpenAI" else 3
     retry_count = 0
 
-    llm = select_llm()
+    engine = variables.selected_llm
+    meter().count(engine, segments=1)
     
     while retry_count < max_retries:
         try:
-            response = llm.invoke(messages)
-            llm_translation = response.translation
+            parsed, (prompt_tokens, completion_tokens) = await invoke_llm(messages)
+            segment.prompt_tokens += prompt_tokens
+            segment.completion_tokens += completion_tokens
+            total_tokens = prompt_tokens + completion_tokens
+            meter().count(engine, tokens_in=prompt_tokens, tokens_out=completion_tokens)
+            llm_translation = parsed.translation
             corrected_llm_translation = correction(llm_translation, source_text)
             if len(source_tags_dict) >= 1:
                 if check_for_tags(corrected_llm_translation, source_tags_dict):
                     corrected_llm_translation = restore_tags(corrected_llm_translation, source_tags_dict)
             retry_reason = should_retry(source_text, corrected_llm_translation)
-            if hasattr(response, "response_metadata") and response.response_metadata:
-                total_tokens = response.response_metadata.get("token_usage", {}).get("total_tokens", None)
-            elif hasattr(response, "usage_metadata") and response.usage_metadata:
-                total_tokens = response.usage_metadata.get("total_tokens", None)
-            else:
-                total_tokens = 0
-            if total_tokens is not None:
-                variables.trans_info["token_count"] =+ total_tokens
+            increment("token_count", total_tokens)
 
             if retry_reason:
+                meter().retry(engine, retry_reason)
                 retry_count += 1
-                time.sleep(retry_delay)
+                await asyncio.sleep(retry_delay)
                 continue
             else:
                 return corrected_llm_translation, prompt
@@ -126,115 +147,218 @@ def chatGPT_translate(row):
             print(error_message)
             retry_count += 1
             retry_reason = f"Reason: {e}"
-            time.sleep(retry_delay)
+            meter().retry(engine, f"Error: {type(e).__name__}")
+            await asyncio.sleep(retry_delay)
 
     error = f"::LLM_FAIL({retry_reason})::"
-    variables.trans_info["translation_failed"] += 1
+    increment("translation_failed")
     return error, prompt
 
-def chatGPT_improve_tm(row, translation_memory):
-    segment_from_row = row["Source"]
-    segment_context = row["Context"]
-    
-    source_text, source_tags_dict = create_tag_dict(segment_from_row)
-    target_text, target_tags_dict = create_tag_dict(translation_memory)
+def parse_response(response):
+    """Splits a structured output response (with_structured_output(include_raw=True)).
+    Returns the parsed output and the token usage: (prompt tokens, completion tokens).
+    Raises the parsing error of an invalid output.
+    """
+    if response["parsed"] is None:
+        raise response["parsing_error"] or ValueError("The LLM returned no output.")
+    usage = getattr(response["raw"], "usage_metadata", None) or {}
+    return response["parsed"], (usage.get("input_tokens", 0), usage.get("output_tokens", 0))
 
-    if variables.trans_info["source_language"] in variables.language_locale.keys():
-        source_language_name = variables.language_locale[variables.trans_info["source_language"]]
-    else:
-        source_language_name = variables.trans_info["source_language"]
-        
-    if variables.trans_info["target_language"] in variables.language_locale.keys():
-        target_language_name = variables.language_locale[variables.trans_info["target_language"]]
-    else:
-        target_language_name = variables.trans_info["target_language"]
-        
-    
-    if not source_text:
-        print("Source is empty, skipping...")
-        return ""
-    
-    prompt = f"Revise the translation of the text below from {source_language_name} to {target_language_name}. Respond using JSON only."
-    prompt += f"\nThe translation provided is from the translation memory. Do not change the sentence structure or word order if possible."
-    prompt += f"\nOnly revise the incorrect parts, make sure the translation is similar to translation memory."
-    
-    if is_numbered_list(source_text):
-        prompt += "\nSource text starts with a numbered list, your translation must start with the same numbered list."
-        
-    if is_bracketed_number(source_text):
-        prompt += "\nSource text contains numbers in brackets, your translation must include the same numbers in same brackets in correct positions."
-    
-    relevant_glossary = {}
-    
-    if variables.trans_info["tb_df"] is not None:
-        relevant_glossary = check_termbase(source_text)        
-                                           
-    if len(relevant_glossary) > 0:
-        prompt += "Strictly use this termbase:\n"
-        for index, info in relevant_glossary.items():
-            source = info["Source"]
-            target = info["Target"]
-            prompt += f"- {source} = {target}.\n"  
-                        
-    #prompt += "\nRespond after 'Revised Translation:' with nothing but your revised translation."
-    if segment_context.strip() != "N/A" and segment_context.strip() != "":
-        prompt += f"\nAdditional info about the segment to help you translate: \n{segment_context}"
-    prompt += "\nText:"
-    prompt += f"\n{source_text}"
-    prompt += f"\nTranslation (from translation memory):"
-    prompt += f"\n{target_text}"
-    #prompt += f"\nRevised Translation:"
-    
-    messages = [
-        (
-            "system",
-            "You are a localization & translation expert.",
-        ),
-        ("human", prompt),
-    ]
+class PromptBuilder:
+    """Assembles the LLM messages of a language pair.
+    The system message holds everything that doesn't change during a run (role, language pair, rules), it is built once
+    per task, so every request of a run starts with the same prefix and reuses the prompt cache of OpenAI or the KV cache of Ollama.
+    The parts of the segments (termbase, context, text, TM) come last, in the human message.
+    """
+    ROLE = "You are a localization & translation expert."
+
+    def __init__(self, source_language: str, target_language: str):
+        source_language_name = language_name(source_language)
+        target_language_name = language_name(target_language)
+        self.prefixes = {
+            "translate": "\n".join([
+                self.ROLE,
+                f"Translate the text from {source_language_name} to {target_language_name}. Respond using JSON only.",
+                "If the text starts with a numbered list, your translation must start with the same numbered list.",
+                "If the text contains numbers in brackets, your translation must include the same numbers in same brackets in correct positions.",
+                "If a termbase is given, strictly use it.",
+            ]),
+            "revise": "\n".join([
+                self.ROLE,
+                f"Revise the translation of the text from {source_language_name} to {target_language_name}. Respond using JSON only.",
+                "The translation provided is from the translation memory. Do not change the sentence structure or word order if possible.",
+                "Only revise the incorrect parts, make sure the translation is similar to translation memory.",
+                "If the text starts with a numbered list, your translation must start with the same numbered list.",
+                "If the text contains numbers in brackets, your translation must include the same numbers in same brackets in correct positions.",
+                "If a termbase is given, strictly use it.",
+            ]),
+            "translate_batch": "\n".join([
+                self.ROLE,
+                f"Translate each of the texts from {source_language_name} to {target_language_name}. Respond using JSON only, with one translation for every id.",
+                "When a text starts with a numbered list, its translation must start with the same numbered list.",
+                "When a text contains numbers in brackets, its translation must include the same numbers in same brackets in correct positions.",
+                "If a termbase is given, strictly use it.",
+            ]),
+            "revise_batch": "\n".join([
+                self.ROLE,
+                f"Revise the translations of the texts from {source_language_name} to {target_language_name}. Respond using JSON only, with one translation for every id.",
+                "The translations provided are from the translation memory. Do not change the sentence structure or word order if possible.",
+                "Only revise the incorrect parts, make sure each translation is similar to its translation memory.",
+                "When a text starts with a numbered list, its translation must start with the same numbered list.",
+                "When a text contains numbers in brackets, its translation must include the same numbers in same brackets in correct positions.",
+                "If a termbase is given, strictly use it.",
+            ]),
+        }
+
+    def messages(self, source_text: str, segment_context: str, target_text: str = None):
+        "Returns the messages of one segment, target_text is the TM target of a revision."
+        parts = self.termbase_part(check_termbase(source_text).values())
+        parts += self.text_part(source_text, segment_context, target_text)
+        task = "translate" if target_text is None else "revise"
+        return [("system", self.prefixes[task]), ("human", "\n".join(parts))]
+
+    def batch_messages(self, pending, revision: bool = False):
+        "Returns the messages of a batch request, the texts are numbered from 1 in the order of pending."
+        relevant_glossary = {}
+        if variables.trans_info["tb"] is not None:
+            for _, source_text, _, _, _ in pending:
+                for info in check_termbase(source_text).values():
+                    relevant_glossary.setdefault(info["Source"], info)
+        blocks = ["\n".join(self.termbase_part(relevant_glossary.values()))] if relevant_glossary else []
+        for item_id, (_, source_text, _, segment_context, target_text) in enumerate(pending, start=1):
+            blocks.append("\n".join([f"Id: {item_id}"] + self.text_part(source_text, segment_context, target_text)))
+        task = "revise_batch" if revision else "translate_batch"
+        return [("system", self.prefixes[task]), ("human", "\n\n".join(blocks))]
+
+    def termbase_part(self, glossary):
+        parts = [f"- {info['Source']} = {info['Target']}." for info in glossary]
+        return ["Termbase:"] + parts if parts else []
+
+    def text_part(self, source_text: str, segment_context: str, target_text: str = None):
+        parts = []
+        if segment_context.strip() != "N/A" and segment_context.strip() != "":
+            parts.append(f"Additional info about the text to help you translate: \n{segment_context}")
+        parts.append(f"Text:\n{source_text}")
+        if target_text is not None:
+            parts.append(f"Translation (from translation memory):\n{target_text}")
+        return parts
+
+    def log(self, messages):
+        "Returns the prompt of the messages for the translation log."
+        return "\n".join(content for _, content in messages)
+
+@functools.lru_cache(maxsize=8)
+def prompt_builder(source_language: str, target_language: str):
+    "Returns the PromptBuilder of a language pair, the prefixes are built once."
+    return PromptBuilder(source_language, target_language)
+
+def estimate_tokens(text: str):
+    "Rough token count of a text (4 characters per token), used to size the batches."
+    return len(text) // 4 + 1
+
+def language_name(language_code: str):
+    return variables.language_locale.get(language_code, language_code)
+
+async def chatGPT_translate_batch(segments):
+    """Translates several segments with one LLM request per attempt.
+    Returns a list of (translation, translation log), in the order of the segments.
+    """
+    return await llm_batch(segments)
+
+async def chatGPT_improve_tm_batch(segments, translation_memories):
+    """Revises the translation memory matches of several segments with one LLM request per attempt.
+    translation_memories -> TM target of every segment, in the order of the segments.
+    Returns a list of (translation, translation log), in the order of the segments.
+    """
+    return await llm_batch(segments, translation_memories)
+
+async def llm_batch(segments, translation_memories=None):
+    """Sends the segments in one request with a structured list output ({id, translation} per segment).
+    Every answer is validated on its own, only the segments with a missing or invalid answer are sent again.
+    """
+    builder = prompt_builder(variables.trans_info["source_language"], variables.trans_info["target_language"])
+
+    results = [None] * len(segments)
+    pending = []
+    for index, segment in enumerate(segments):
+        source_text, source_tags_dict = segment.masked()
+        if not source_text:
+            results[index] = ("", "")
+            continue
+        target_text = create_tag_dict(translation_memories[index])[0] if translation_memories else None
+        pending.append((index, source_text, source_tags_dict, segment.context, target_text))
 
     max_retries = 10
     retry_delay = 20 if variables.selected_llm == "OpenAI" else 3
     retry_count = 0
+    retry_reasons = {}
+    prompt = ""
+    engine = variables.selected_llm
+    meter().count(engine, segments=len(pending))
+
+    while pending and retry_count < max_retries:
+        messages = builder.batch_messages(pending, translation_memories is not None)
+        prompt = builder.log(messages)
+        output_tokens = sum(estimate_tokens(source_text) for _, source_text, _, _, _ in pending)
+        # rounded up to a power of two, so a run only needs a few LLM configurations
+        num_predict = 1 << (2 * output_tokens + 32 * len(pending) - 1).bit_length()
 
-    llm = select_llm()
-    
-    while retry_count < max_retries:
         try:
-            response = llm.invoke(messages)
-            llm_translation = response.translation
-            corrected_llm_translation = correction(llm_translation, source_text)
+            parsed, usage = await invoke_llm(messages, BatchTranslationRequest, num_predict)
+            share_tokens(pending, segments, usage)
+            meter().count(engine, tokens_in=usage[0], tokens_out=usage[1])
+            increment("token_count", sum(usage))
+            translations = {item.id: item.translation for item in parsed.translations}
+        except Exception as e:
+            print(f"An error occurred: {e}. Retrying after a delay.")
+            for index, *_ in pending:
+                retry_reasons[index] = f"Reason: {e}"
+            meter().retry(engine, f"Error: {type(e).__name__}")
+            retry_count += 1
+            await asyncio.sleep(retry_delay)
+            continue
+
+        failed = []
+        for item_id, item in enumerate(pending, start=1):
+            index, source_text, source_tags_dict, _, _ = item
+            if item_id not in translations:
+                retry_reasons[index] = "No translation returned for the segment."
+                meter().retry(engine, retry_reasons[index])
+                failed.append(item)
+                continue
+            corrected_llm_translation = correction(translations[item_id], source_text)
             if len(source_tags_dict) >= 1:
                 if check_for_tags(corrected_llm_translation, source_tags_dict):
                     corrected_llm_translation = restore_tags(corrected_llm_translation, source_tags_dict)
             retry_reason = should_retry(source_text, corrected_llm_translation)
-            if hasattr(response, "response_metadata") and response.response_metadata:
-                total_tokens = response.response_metadata.get("token_usage", {}).get("total_tokens", None)
-            elif hasattr(response, "usage_metadata") and response.usage_metadata:
-                total_tokens = response.usage_metadata.get("total_tokens", None)
-            else:
-                total_tokens = 0
-            if total_tokens is not None:
-                variables.trans_info["token_count"] =+ total_tokens
-
             if retry_reason:
-                retry_count += 1
-                time.sleep(retry_delay)
-                continue
+                retry_reasons[index] = retry_reason
+                meter().retry(engine, retry_reason)
+                failed.append(item)
             else:
-                return corrected_llm_translation, prompt
+                results[index] = (corrected_llm_translation, prompt)
 
-        except Exception as e:
-            error_message = f"An error occurred: {e}. Retrying after a delay."
-            print(error_message)
+        pending = failed
+        if pending:
             retry_count += 1
-            retry_reason = f"Reason: {e}"
-            time.sleep(retry_delay)
+            await asyncio.sleep(retry_delay)
 
-    error = f"::LLM_FAIL({retry_reason})::"
-    variables.trans_info["translation_failed"] += 1
-    return error, prompt
- 
+    for index, *_ in pending:
+        results[index] = (f"::LLM_FAIL({retry_reasons[index]})::", prompt)
+        increment("translation_failed")
+    return results
+
+def share_tokens(pending, segments, usage):
+    """Adds the token usage of a batch request to its segments.
+    The prompt tokens are shared by the size of the texts, the completion tokens by the size of the sources.
+    """
+    prompt_tokens, completion_tokens = usage
+    prompt_weights = [estimate_tokens(source_text) + (estimate_tokens(target_text) if target_text else 0) for _, source_text, _, _, target_text in pending]
+    completion_weights = [estimate_tokens(source_text) for _, source_text, _, _, _ in pending]
+    for item, prompt_weight, completion_weight in zip(pending, prompt_weights, completion_weights):
+        segment = segments[item[0]]
+        segment.prompt_tokens += round(prompt_tokens * prompt_weight / sum(prompt_weights))
+        segment.completion_tokens += round(completion_tokens * completion_weight / sum(completion_weights))
 
 def correction(improved_translation, source_text):
     if "Source Text:" in improved_translation:
@@ -1,20 +1,26 @@
-import deepl, re, time, variables
-from segment import create_tag_dict, restore_tags
-from deepl import DeepLException, TooManyRequestsException, AuthorizationException
+import asyncio, httpx, re, time, variables
+from segment import restore_tags
+from engine import hedged, http_client, rate_limit, request_slot
+from metering import meter
+from deepl import DeepLException, TooManyRequestsException, AuthorizationException, QuotaExceededException
+from deepl.util import auth_key_is_free_account
 
-def deepl_translate(row, translation_memory=None, max_retries=5):
+DEEPL_SERVER_URL = "https://api.deepl.com"
+DEEPL_SERVER_URL_FREE = "https://api-free.deepl.com"
+DEEPL_TIMEOUT = 30
+
+async def deepl_translate(segment, translation_memory=None, max_retries=5):
     """Translates the segment using DeepL.
     Returns translated string and translation log.
-    Handles retry logic for high server load and other errors.
+    Handles retry logic for high server load and other errors, the backoff doesn't block the event loop.
+    The billed characters are added to the segment and metered.
     """
-    segment_source_text = row['Source']
-
     if translation_memory:
         segment_context = translation_memory
     else:
-        segment_context = row['Context']
+        segment_context = segment.context
 
-    source_text, source_tags_dict = create_tag_dict(segment_source_text)
+    source_text, source_tags_dict = segment.masked()
 
     source_language = re.sub(r'_', '-', variables.trans_info["source_language"])
     target_language = re.sub(r'_', '-', variables.trans_info["target_language"])
@@ -23,23 +29,20 @@ def deepl_translate(row, translation_memory=None, max_retries=5):
     source_language = source_language.upper()
     target_language = target_language.upper()
 
-    translator = deepl.Translator(variables.deepl_api)
-
     retry_delay = 1  
+    client = http_client("DeepL", DEEPL_TIMEOUT)
+    meter().count("DeepL", segments=1)
     for attempt in range(max_retries):
         try:
-            result = translator.translate_text(
-                text=source_text,
-                source_lang=source_language,
-                target_lang=target_language,
-                context=segment_context,
-                tag_handling='xml',
-            )
-            deepl_translation = restore_tags(result.text, source_tags_dict)
+            result_text, billed_characters = await deepl_request(client, source_text, source_language, target_language, segment_context)
+            segment.billed_characters += billed_characters
+            meter().count("DeepL", billed_characters=billed_characters)
+            deepl_translation = restore_tags(result_text, source_tags_dict)
             break  # Success, exit retry loop
-        except TooManyRequestsException:
+        except (TooManyRequestsException, httpx.TransportError) as e:
+            meter().retry("DeepL", f"HTTP {e.http_status_code}" if isinstance(e, DeepLException) else f"Error: {type(e).__name__}")
             if attempt < max_retries - 1:
-                time.sleep(retry_delay)
+                await asyncio.sleep(retry_delay)
                 retry_delay *= 2  # Exponential backoff
             else:
                 return "", f"Translation failed: DeepL server is overloaded after {max_retries} retries."
@@ -57,6 +60,51 @@ def deepl_translate(row, translation_memory=None, max_retries=5):
 
     return deepl_translation, translation_log
 
+async def deepl_request(client, source_text, source_language, target_language, segment_context):
+    """Sends one translation request to the DeepL API (v2/translate), a slow request may be hedged (hedged).
+    Returns the translated text and the billed characters. Raises the deepl exception of an error status (raise_for_deepl_status).
+    """
+    server_url = DEEPL_SERVER_URL_FREE if auth_key_is_free_account(variables.deepl_api) else DEEPL_SERVER_URL
+    request_data = {
+        "text": [source_text],
+        "source_lang": source_language,
+        "target_lang": target_language,
+        "tag_handling": "xml",
+        "show_billed_characters": True,
+    }
+    if segment_context:
+        request_data["context"] = segment_context
+
+    async def send(sent):
+        async with request_slot(), rate_limit("DeepL"):
+            sent.set()
+            started = time.perf_counter()
+            response = await client.post(f"{server_url}/v2/translate", json=request_data,
+                                         headers={"Authorization": f"DeepL-Auth-Key {variables.deepl_api}"})
+            meter().request("DeepL", time.perf_counter() - started)
+        # an error raises inside the hedged request, so a failed duplicate never wins the race
+        raise_for_deepl_status(response)
+        translation = response.json()["translations"][0]
+        return translation["text"], translation.get("billed_characters", len(source_text))
+
+    return await hedged("DeepL", send)
+
+def raise_for_deepl_status(response):
+    "Raises the deepl exception of an error status of a DeepL API response, server errors raise TooManyRequestsException."
+    if response.status_code == 200:
+        return
+    try:
+        message = f", message: {response.json()['message']}"
+    except Exception:
+        message = ""
+    if response.status_code == 429 or response.status_code >= 500:
+        raise TooManyRequestsException(f"DeepL server error {response.status_code}{message}", should_retry=True, http_status_code=response.status_code)
+    if response.status_code == 403:
+        raise AuthorizationException(f"Authorization failure, check auth_key{message}", http_status_code=response.status_code)
+    if response.status_code == 456:
+        raise QuotaExceededException(f"Quota for this billing period has been exceeded{message}", http_status_code=response.status_code)
+    raise DeepLException(f"Request failed with status {response.status_code}{message}", http_status_code=response.status_code)
+
 
 def lang_code_fix(is_source, lang_code):
     if not is_source and lang_code.upper() == "EN":
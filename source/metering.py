@@ -0,0 +1,121 @@
+import json, math, threading, time, variables
+from collections import Counter
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 30, math.inf)
+counter_lock = threading.Lock()
+
+def increment(key: str, amount: int = 1):
+    "Adds to a counter of variables.trans_info (segments_translated, translation_failed...) under a lock."
+    with counter_lock:
+        variables.trans_info[key] += amount
+
+class EngineUsage:
+    "Counters and latency histogram of one engine."
+
+    def __init__(self):
+        self.counts = Counter()
+        self.retry_reasons = Counter()
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+        self.latencies = []
+
+    def observe_latency(self, seconds: float):
+        self.latencies.append(seconds)
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.latency_buckets[index] += 1
+                break
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        segments = self.counts["segments"]
+        return {
+            **{key: round(value, 3) if isinstance(value, float) else value for key, value in self.counts.items()},
+            "retry_reasons": dict(self.retry_reasons.most_common()),
+            "per_segment": {key: round(self.counts[key] / segments, 1) for key in ("tokens_in", "tokens_out", "billed_characters", "requests") if segments and key in self.counts},
+            "latency": {
+                "count": len(latencies),
+                "mean": round(sum(latencies) / len(latencies), 3) if latencies else None,
+                "p50": percentile(latencies, 50),
+                "p90": percentile(latencies, 90),
+                "p99": percentile(latencies, 99),
+                "max": round(latencies[-1], 3) if latencies else None,
+                "histogram": {f"<={bound}s" if bound != math.inf else "more": count for bound, count in zip(LATENCY_BUCKETS, self.latency_buckets)},
+            },
+        }
+
+def percentile(sorted_values: list, percent: float):
+    "Returns the percentile of sorted values (nearest rank), None without values."
+    if not sorted_values:
+        return None
+    return round(sorted_values[max(0, math.ceil(len(sorted_values) * percent / 100) - 1)], 3)
+
+class Meter:
+    """Usage of the engines during a run: requests, tokens in/out, DeepL billed characters, latency, retry reasons and 429s.
+    Every engine (DeepL, OpenAI, Ollama) has its own EngineUsage, all updates hold the lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.engines = {}
+        self.started = time.time()
+
+    def usage(self, engine: str):
+        if engine not in self.engines:
+            self.engines[engine] = EngineUsage()
+        return self.engines[engine]
+
+    def count(self, engine: str, **amounts):
+        "Adds to the counters of an engine, e.g. count(\"OpenAI\", tokens_in=120, tokens_out=30)."
+        with self.lock:
+            self.usage(engine).counts.update(amounts)
+
+    def request(self, engine: str, seconds: float):
+        "Records one engine request and its latency: from sending (after its turn of the RateLimiter) to the full response."
+        with self.lock:
+            usage = self.usage(engine)
+            usage.counts["requests"] += 1
+            usage.observe_latency(seconds)
+
+    def retry(self, engine: str, reason: str):
+        with self.lock:
+            usage = self.usage(engine)
+            usage.counts["retries"] += 1
+            usage.retry_reasons[reason] += 1
+
+    def report(self, segments=()):
+        """Returns the usage report of the run: the segment counters, the usage of every engine
+        and the tokens or billed characters of every segment that was sent to an engine.
+        """
+        with self.lock:
+            engines = {engine: usage.report() for engine, usage in self.engines.items()}
+        counters = ("segments_translated", "segments_repeated", "segments_skipped", "translation_failed",
+                    "tm_match", "tm_match_partial", "cache_hits", "cache_misses", "token_count")
+        with counter_lock:
+            totals = {key: variables.trans_info[key] for key in counters}
+        return {
+            "file": variables.trans_info["file_name"],
+            "version": variables.trans_version,
+            "source_language": variables.trans_info["source_language"],
+            "target_language": variables.trans_info["target_language"],
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "duration_seconds": round(time.time() - self.started, 1),
+            "totals": totals,
+            "engines": engines,
+            "segments": [
+                {"file": segment.file, "segment_id": segment.segment_id, "prompt_tokens": segment.prompt_tokens,
+                 "completion_tokens": segment.completion_tokens, "billed_characters": segment.billed_characters}
+                for segment in segments if segment.prompt_tokens or segment.completion_tokens or segment.billed_characters
+            ],
+        }
+
+    def write_report(self, file_path: str, segments=()):
+        "Writes the usage report as JSON."
+        with open(file_path, "w", encoding="utf-8") as f:
+            json.dump(self.report(segments), f, ensure_ascii=False, indent=2)
+
+def meter():
+    "Returns the Meter of the run, outside of a run a new one (its counts are discarded)."
+    run_meter = variables.trans_info["meter"]
+    if run_meter is None:
+        return Meter()
+    return run_meter
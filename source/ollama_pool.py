@@ -0,0 +1,137 @@
+import asyncio, contextlib, httpx, re, time, variables
+from ollama import ResponseError
+from engine import http_client
+
+OLLAMA_TIMEOUT = 30
+OLLAMA_WARMUP_TIMEOUT = 600
+OLLAMA_KEEP_ALIVE = "30m"
+OLLAMA_RETRY_DOWN_HOST = 30
+
+def ollama_hosts(hosts: str = None):
+    "Returns the base URLs of the Ollama host setting, several hosts are separated by commas or spaces."
+    hosts = variables.ollama_host if hosts is None else hosts
+    return [host.rstrip("/") for host in re.split(r"[,\s]+", hosts or "") if host]
+
+class OllamaHost:
+    "One Ollama server of the pool, at most slots requests are sent to it at the same time."
+
+    def __init__(self, url: str, slots: int):
+        self.url = url
+        self.slots = slots
+        self.outstanding = 0
+        self.healthy = True
+        self.down_until = 0.0
+        self.served = 0
+        self.failed = 0
+        self.has_model = True
+
+    def available(self):
+        "A host marked down is tried again after OLLAMA_RETRY_DOWN_HOST seconds."
+        return self.healthy or time.monotonic() >= self.down_until
+
+    def mark_down(self, reason: str):
+        if self.healthy:
+            print(f"Ollama host {self.url} is unavailable, retrying it in {OLLAMA_RETRY_DOWN_HOST}s: {reason}")
+        self.healthy = False
+        self.down_until = time.monotonic() + OLLAMA_RETRY_DOWN_HOST
+
+class OllamaPool:
+    """Ollama servers of a run, every request goes to the available host with the fewest outstanding requests.
+    Before dispatch starts, every host is checked (reachable, model installed) and the model is loaded with
+    keep_alive, so the first segments don't wait for a cold load and the model stays loaded between jobs.
+    slots -> Parallel requests of a server (OLLAMA_NUM_PARALLEL). Requests above the slots of all hosts wait in
+    one queue of the pool and take the first slot that is freed, so a slow host doesn't collect a queue of its own.
+    """
+
+    def __init__(self, urls: list, model: str, slots: int):
+        self.model = model
+        self.hosts = [OllamaHost(url, slots) for url in urls]
+        self.condition = asyncio.Condition()
+
+    async def start(self):
+        "Checks and warms up all hosts at the same time, the hosts without the model are left out of the run."
+        await asyncio.gather(*(self.warm_up(host) for host in self.hosts))
+        self.hosts = [host for host in self.hosts if host.has_model] or self.hosts
+        if not any(host.healthy for host in self.hosts):
+            print("No Ollama host passed the health check, sending the requests to all hosts.")
+            for host in self.hosts:
+                host.healthy = True
+
+    async def warm_up(self, host: OllamaHost):
+        client = http_client("Ollama", OLLAMA_TIMEOUT)
+        try:
+            response = await client.get(f"{host.url}/api/tags")
+            response.raise_for_status()
+            models = {model.get("name") for model in response.json().get("models", [])} | {model.get("model") for model in response.json().get("models", [])}
+            if self.model not in models:
+                host.has_model = False
+                host.mark_down(f"model {self.model} is not installed")
+                return
+            started = time.perf_counter()
+            response = await client.post(f"{host.url}/api/generate", json={"model": self.model, "keep_alive": OLLAMA_KEEP_ALIVE},
+                                         timeout=OLLAMA_WARMUP_TIMEOUT)
+            response.raise_for_status()
+            print(f"Ollama host {host.url} is ready, {self.model} loaded in {time.perf_counter() - started:.1f}s")
+        except (httpx.HTTPError, ValueError) as e:
+            host.mark_down(str(e) or type(e).__name__)
+
+    def select(self):
+        "Returns the available host with a free slot and the fewest outstanding requests, or None."
+        hosts = [host for host in self.hosts if host.available()] or self.hosts
+        free_hosts = [host for host in hosts if host.outstanding < host.slots]
+        if not free_hosts:
+            return None
+        return min(free_hosts, key=lambda host: host.outstanding)
+
+    @contextlib.asynccontextmanager
+    async def host(self):
+        """Holds a slot of the least busy host for one request (async with pool.host() as url: ...).
+        A connection or server error marks the host down, the request's retry goes to another host.
+        """
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.select() is not None)
+            host = self.select()
+            host.outstanding += 1
+        try:
+            yield host.url
+            host.served += 1
+            host.healthy = True
+        except (ConnectionError, httpx.TransportError) as e:
+            host.failed += 1
+            host.mark_down(str(e) or type(e).__name__)
+            raise
+        except ResponseError as e:
+            host.failed += 1
+            if e.status_code == 404 or e.status_code >= 500:
+                host.mark_down(str(e))
+            raise
+        finally:
+            async with self.condition:
+                host.outstanding -= 1
+                self.condition.notify_all()
+
+    def summary(self):
+        return ", ".join(f"{host.url}: {host.served} requests, {host.failed} failed" for host in self.hosts)
+
+async def open_ollama_pool():
+    "Creates, checks and warms up the Ollama pool of a run (variables.ollama_host, variables.ollama_slots)."
+    pool = OllamaPool(ollama_hosts(), variables.ollama_model, variables.ollama_slots)
+    await pool.start()
+    variables.trans_info["ollama_pool"] = pool
+
+def close_ollama_pool():
+    pool = variables.trans_info["ollama_pool"]
+    variables.trans_info["ollama_pool"] = None
+    if pool is not None:
+        print(f"Ollama hosts: {pool.summary()}")
+
+@contextlib.asynccontextmanager
+async def ollama_host():
+    "Yields the Ollama host of one request (OllamaPool.host), outside of a run the first configured host."
+    pool = variables.trans_info["ollama_pool"]
+    if pool is None:
+        hosts = ollama_hosts()
+        yield hosts[0] if hosts else None
+        return
+    async with pool.host() as url:
+        yield url
@@ -1,60 +1,122 @@
+import numpy as np
 import pandas as pd
 import re, variables, html
 
-def check_tm(segment: str, dataframe: pd.DataFrame, source_col : str ="Source", target_col : str ="Target", threshold : int =80):
+def check_tm(segment: str, tm, source_col : str ="Source", target_col : str ="Target", threshold : int =80):
     """Checks the translation memory to find a fuzzy match. 
     segment -> Input segment
-    df -> Translation memory as pandas dataframe
-    source_col -> Source segment column name of the df
-    target_col -> Target segment column name of the df
+    tm -> Translation memory (TranslationMemory, PersistentTranslationMemory or pandas dataframe) or a list of them
+    source_col -> Source segment column name of the result
+    target_col -> Target segment column name of the result
     treshold -> Fuzzy match percent
 
     Returns -> highest fuzzy match as pd.Series() or an empty pd.Series() if no valid translation memory
     """
-    if dataframe.empty:
-        return pd.Series()
-    
-    def fuzzy_match(translation_memory):
-        if len(translation_memory) <= 0 or len(segment) <= 0:
-            return 0
-        distance = lev_distance(translation_memory, segment)
-        max_length = max(len(translation_memory), len(segment))
-        if max_length == 0:
-            return 0
-        else:
-            similarity = 1.0 - distance / max_length
-            fuzzy_percent = float(similarity) * 100
-            return fuzzy_percent       
-    
-    dataframe["Similarity"] = dataframe[source_col].apply(fuzzy_match)
-    
-    filtered_df = dataframe[dataframe["Similarity"] > threshold]
-    
-    if not filtered_df.empty:
-        best_match = filtered_df.loc[filtered_df["Similarity"].idxmax()]
-        return best_match[[source_col, target_col, "Similarity"]]
-    else:
+    translation_memories = tm if isinstance(tm, (list, tuple)) else [tm]
+    best_match = None
+
+    for translation_memory in translation_memories:
+        if translation_memory is None or len(translation_memory) == 0:
+            continue
+        if isinstance(translation_memory, pd.DataFrame):
+            from translation_memory import TranslationMemory
+            translation_memory = TranslationMemory.from_dataframe(translation_memory, source_col, target_col)
+
+        match = translation_memory.lookup(segment, threshold)
+        if match is not None and (best_match is None or match[2] > best_match[2]):
+            best_match = match
+
+    if best_match is None:
         return pd.Series()
 
-def lev_distance(s1: str, s2: str):
-    "Simple function to check levenshtein distance between segments"
+    source, target, similarity = best_match
+    return pd.Series({source_col: source, target_col: target, "Similarity": similarity})
+
+def lev_distance(s1: str, s2: str, max_distance: int = None):
+    """Levenshtein distance between segments (bit-parallel Myers/Hyyro algorithm).
+    max_distance -> Optional bound. The computation stops as soon as the bound can't be reached
+    and max_distance + 1 is returned.
+    """
     if len(s1) < len(s2):
-        return lev_distance(s2, s1)
+        s1, s2 = s2, s1
+
+    if max_distance is None:
+        max_distance = len(s1)
+    elif len(s1) - len(s2) > max_distance:
+        return max_distance + 1
 
     if len(s2) == 0:
-        return len(s1)
+        return min(len(s1), max_distance + 1)
+
+    pattern_masks = {}
+    for i, c in enumerate(s2):
+        pattern_masks[c] = pattern_masks.get(c, 0) | (1 << i)
+
+    all_ones = (1 << len(s2)) - 1
+    last_bit = 1 << (len(s2) - 1)
+    positive_vector = all_ones
+    negative_vector = 0
+    distance = len(s2)
+    remaining = len(s1)
+
+    for c in s1:
+        equal_mask = pattern_masks.get(c, 0)
+        vertical_x = equal_mask | negative_vector
+        horizontal_x = (((equal_mask & positive_vector) + positive_vector) ^ positive_vector) | equal_mask
+        positive_horizontal = negative_vector | (~(horizontal_x | positive_vector) & all_ones)
+        negative_horizontal = positive_vector & horizontal_x
+        if positive_horizontal & last_bit:
+            distance += 1
+        elif negative_horizontal & last_bit:
+            distance -= 1
+        remaining -= 1
+        # each remaining character can lower the distance by one at most
+        if distance - remaining > max_distance:
+            return max_distance + 1
+        positive_horizontal = ((positive_horizontal << 1) | 1) & all_ones
+        negative_horizontal = (negative_horizontal << 1) & all_ones
+        positive_vector = negative_horizontal | (~(vertical_x | positive_horizontal) & all_ones)
+        negative_vector = positive_horizontal & vertical_x
+
+    return min(distance, max_distance + 1)
+
+def lev_distance_batch(segment: str, candidates: list, max_distance: int = None):
+    """Levenshtein distance between one segment and many candidates at once (NumPy).
+    Each dynamic programming row is computed for all candidates together, insertions are
+    resolved with a cumulative minimum.
+    max_distance -> Optional bound. Distances above it are returned as max_distance + 1 and
+    the computation stops once no candidate can reach it.
+    Returns a numpy array of distances in the order of the candidates.
+    """
+    candidate_lengths = np.fromiter((len(candidate) for candidate in candidates), dtype=np.int32, count=len(candidates))
+    if len(candidates) == 0:
+        return candidate_lengths
 
-    previous_row = range(len(s2) + 1)
-    for i, c1 in enumerate(s1):
-        current_row = [i + 1]
-        for j, c2 in enumerate(s2):
-            insertions = previous_row[j + 1] + 1
-            deletions = current_row[j] + 1
-            substitutions = previous_row[j] + (c1 != c2)
-            current_row.append(min(insertions, deletions, substitutions))
-        previous_row = current_row
+    cap = max_distance + 1 if max_distance is not None else None
+    if len(segment) == 0:
+        return candidate_lengths if cap is None else np.minimum(candidate_lengths, cap)
 
-    return previous_row[-1]  
+    width = int(candidate_lengths.max())
+    candidate_codes = np.full((len(candidates), width), -1, dtype=np.int64)
+    for row, candidate in enumerate(candidates):
+        if candidate:
+            candidate_codes[row, :len(candidate)] = np.frombuffer(candidate.encode("utf-32-le"), dtype=np.uint32)
+    segment_codes = np.frombuffer(segment.encode("utf-32-le"), dtype=np.uint32).astype(np.int64)
+
+    columns = np.arange(width + 1, dtype=np.int32)
+    previous_row = np.tile(columns, (len(candidates), 1))
+    current_row = np.empty_like(previous_row)
+
+    for i, code in enumerate(segment_codes, start=1):
+        current_row[:, 0] = i
+        np.minimum(previous_row[:, :-1] + (candidate_codes != code), previous_row[:, 1:] + 1, out=current_row[:, 1:])
+        current_row = np.minimum.accumulate(current_row - columns, axis=1) + columns
+        if cap is not None and current_row.min() >= cap:
+            return np.full(len(candidates), cap, dtype=np.int32)
+        previous_row, current_row = current_row, previous_row
+
+    distances = previous_row[np.arange(len(candidates)), candidate_lengths]
+    return distances if cap is None else np.minimum(distances, cap)
 
 def is_number(segment: str):
     "Check if segment contains a number"
@@ -74,29 +136,57 @@ def is_bracketed_number(segment: str):
     match = re.search(pattern, segment)
     return bool(match)
 
+class TagCodec:
+    """Masks memoQ tags with numbered placeholders (<UTAG1/>, <UTAG2/>, ...) and restores them.
+    The patterns are compiled once, restoring is a single substitution with a dictionary lookup per placeholder.
+    """
+    TAG_REGEX = re.compile(r"<\/?(tw:it|st:it|mq:nt|mq:it|mq:ch|mq:gap|mq:rxt-req|mq:rxt|mq:txml-ut|mq:pi|bpt|ept|ph|it)(\s[^>]*)?>")
+    PLACEHOLDER_REGEX = re.compile(r"<UTAG\d+/>")
+
+    def mask(self, segment: str):
+        """Replaces the memoQ tags with placeholders.
+        Returns the segment (without tags) and the tags dictionary: placeholder -> decoded tag.
+        """
+        tags_dict = {}
+
+        def replace_tag(match):
+            unique_tag = f"<UTAG{len(tags_dict) + 1}/>"
+            tags_dict[unique_tag] = html.unescape(match.group(0))
+            return unique_tag
+
+        cleaned_text = self.TAG_REGEX.sub(replace_tag, segment)
+        return cleaned_text, tags_dict
+
+    def restore(self, cleaned_text: str, tags_dict: dict):
+        "Restores the placeholders of the tags dictionary in one pass, unknown placeholders are left as they are."
+        if not tags_dict:
+            return cleaned_text
+        return self.PLACEHOLDER_REGEX.sub(lambda match: tags_dict.get(match.group(0), match.group(0)), cleaned_text)
+
+tag_codec = TagCodec()
+
 def create_tag_dict(segment: str):
     """Replaces the memoQ tags with a placeholder (<UTAG{tag_counter}>).
     Creates a dictionary from the segment with memoQ tags.
     Adds the placesholder to the tags dictionary.
     Returns the segment (without tags) and tags dictionary.
     """
-    memoq_regex = r"<\/?(tw:it|st:it|mq:nt|mq:it|mq:ch|mq:gap|mq:rxt-req|mq:rxt|mq:txml-ut|mq:pi|bpt|ept|ph|it)(\s[^>]*)?>"
-    
-    tags_dict = {}
-    tag_counter = 1
-
-    def replace_tag(match):
-        nonlocal tag_counter
-        full_tag = match.group(0)
-        decoded_tag = html.unescape(full_tag)
-        unique_tag = f"<UTAG{tag_counter}/>"
-        tags_dict[unique_tag] = decoded_tag
-        tag_counter += 1
-        return unique_tag
-
-    cleaned_text = re.sub(memoq_regex, replace_tag, segment)
-    
-    return cleaned_text, tags_dict
+    return tag_codec.mask(segment)
+
+def repetition_key(cleaned_text: str):
+    "Key shared by repetitions: the segment with its memoQ tags masked (Segment.masked), whitespace normalized."
+    return re.sub(r"\s+", " ", cleaned_text).strip()
+
+def transfer_tags(translation: str, from_tags: dict, to_tags: dict):
+    """Adapts the translation of a segment to one of its repetitions.
+    The tags of the segment (from_tags) in the translation are replaced with the tags of the repetition (to_tags), by position.
+    Returns the translation for the repetition.
+    """
+    if list(from_tags.values()) == list(to_tags.values()):
+        return translation
+    for unique_tag, tag in from_tags.items():
+        translation = translation.replace(tag, unique_tag, 1)
+    return restore_tags(translation, to_tags)
 
 def find_tag_discrepancies(source_dict, target_dict):
     """Checks if there are any missing tags between the source segment and target segment.
@@ -121,16 +211,7 @@ def remove_discrepant_tags(text: str, tags_to_remove: list):
 
 def restore_tags(cleaned_text: str, tags_dict: dict):
     "Restores placeholder tags in a segment to their original values from the tags dictionary."
-    def extract_number(tag):
-        match = re.search(r"\d+", tag)
-        if match:
-            return int(match.group())
-        else:
-            return float("inf")  
-
-    for unique_tag in sorted(tags_dict.keys(), key=extract_number):
-        cleaned_text = cleaned_text.replace(unique_tag, tags_dict[unique_tag])
-    return cleaned_text
+    return tag_codec.restore(cleaned_text, tags_dict)
 
 def check_for_tags(text: str, tags: list):
     "Checks for tags in a segment."
@@ -167,29 +248,12 @@ def create_memoq_elements_dict(source_element):
     return result
 
 def check_termbase(source_text):
-    relevant_glossary = {}
-    for _, row in variables.trans_info["tb_df"].iterrows():
-        try:
-            source = row["Source"]
-            target = row["Target"]
-            source_lower = source.lower()
-            source_text_lower = source_text.lower()
-            if source_lower in source_text_lower:
-                start_index = 0
-                while True:
-                    index = source_text_lower.find(source_lower, start_index)
-                    if index == -1:
-                        break
-                    if index not in relevant_glossary:
-                        relevant_glossary[index] = {
-                            "Source": source,
-                            "Target": target,
-                        }
-                    start_index = index + len(source_lower)   
-        except Exception as e:
-            print(e)
-            pass  
-    return relevant_glossary
+    """Finds the termbase entries present in the source text with the loaded Termbase automaton.
+    Returns a dictionary: index -> {"Source", "Target"}.
+    """
+    if variables.trans_info["tb"] is None:
+        return {}
+    return variables.trans_info["tb"].find(source_text)
 
 def is_link(segment: str) -> bool:
     """
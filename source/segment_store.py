@@ -0,0 +1,74 @@
+from segment import create_tag_dict
+
+class Segment:
+    """One trans-unit of the job, carried from analysis through write-back.
+    Every segment is only written by the worker it was handed to, so results need no locking.
+    """
+    __slots__ = ("file", "segment_id", "source", "target", "locked", "context", "match", "similarity", "tm_target", "translation", "tag_mask", "prompt_tokens", "completion_tokens", "billed_characters")
+
+    def __init__(self, file: str, segment_id: int, source: str, target: str, locked: str, context: str):
+        self.file = file
+        self.segment_id = segment_id
+        self.source = source
+        self.target = target
+        self.locked = locked
+        self.context = context
+        self.match = ""
+        self.similarity = 0.0
+        self.tm_target = ""
+        self.translation = None
+        self.tag_mask = None
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.billed_characters = 0
+
+    @property
+    def is_locked(self):
+        return self.locked != "Null"
+
+    def masked(self):
+        """Masks the memoQ tags of the source once per run, the engines and the repetition grouping share the result.
+        Returns the source (without tags) and the tags dictionary.
+        """
+        if self.tag_mask is None:
+            self.tag_mask = create_tag_dict(self.source)
+        return self.tag_mask
+
+class SegmentStore:
+    """The segments of a job in document order, indexed by (file, segment id).
+    Replaces the per-job pandas dataframe, a dataframe is only built for the Excel log.
+    """
+
+    def __init__(self):
+        self.segments = []
+        self.index = {}
+
+    def __len__(self):
+        return len(self.segments)
+
+    def __iter__(self):
+        return iter(self.segments)
+
+    def add(self, segment: Segment):
+        self.segments.append(segment)
+        self.index.setdefault((segment.file, segment.segment_id), segment)
+
+    def extend(self, segments):
+        for segment in segments:
+            self.add(segment)
+
+    def get(self, file: str, segment_id: int):
+        return self.index.get((file, segment_id))
+
+    def unlocked(self):
+        "Returns the segments to translate, in document order."
+        return [segment for segment in self.segments if not segment.is_locked]
+
+    def translations(self):
+        """Returns the translations of every document, the first segment wins for a repeated id.
+        Returns a dictionary: file -> {segment id -> translation}.
+        """
+        translations = {}
+        for (file, segment_id), segment in self.index.items():
+            translations.setdefault(file, {})[segment_id] = segment.translation
+        return translations
@@ -2,7 +2,7 @@ from PyQt6.QtGui import QIcon
 import variables
 from PyQt6.QtWidgets import (
     QWidget, QLabel, QLineEdit, QComboBox, QPushButton,
-    QFormLayout, QVBoxLayout, QGroupBox, QSpacerItem, QSizePolicy, QMessageBox, QSlider, QHBoxLayout
+    QFormLayout, QVBoxLayout, QGroupBox, QSpacerItem, QSizePolicy, QMessageBox, QSlider, QSpinBox, QHBoxLayout
 )
 from PyQt6.QtCore import Qt
 from system import save_env
@@ -48,13 +48,24 @@ class SettingsUI(QWidget):
         self.ollama_host_input = QLineEdit()
         self.ollama_host_input.setPlaceholderText("http://localhost:11434")
         self.ollama_host_input.setText(getattr(variables, "ollama_host", "http://localhost:11434"))
+        self.ollama_host_input.setToolTip(
+            "Base URL of the Ollama server. Several servers can be separated by commas, each request goes to the least busy one."
+        )
+        self.ollama_slots_spinbox = QSpinBox()
+        self.ollama_slots_spinbox.setMinimum(1)
+        self.ollama_slots_spinbox.setMaximum(64)
+        self.ollama_slots_spinbox.setValue(getattr(variables, "ollama_slots", 4))
+        self.ollama_slots_spinbox.setToolTip(
+            "Parallel requests of each Ollama server (OLLAMA_NUM_PARALLEL on the server). Requests above it wait in the app."
+        )
         self.ollama_model_combo = QComboBox()
         self.ollama_model_combo.setEditable(False)
         self.ollama_get_models_button = QPushButton("Get Models")
         self.ollama_get_models_button.clicked.connect(self.get_ollama_models)
         if hasattr(variables, "ollama_model"):
             self.ollama_model_combo.setCurrentText(variables.ollama_model)
-        ollama_layout.addRow(QLabel("Ollama Host URL:"), self.ollama_host_input)
+        ollama_layout.addRow(QLabel("Ollama Host URL(s):"), self.ollama_host_input)
+        ollama_layout.addRow(QLabel("Ollama Slots per Host:"), self.ollama_slots_spinbox)
         ollama_layout.addRow(QLabel("Ollama Model:"), self.ollama_model_combo)
         ollama_layout.addRow(self.ollama_get_models_button)
 
@@ -78,23 +89,42 @@ class SettingsUI(QWidget):
         method_layout.addRow(QLabel("Translation Method:"), self.translation_method_combo)
         method_layout.addRow(QLabel("Revision Method:"), self.revision_method_combo)
 
-        self.threads_slider = QSlider(Qt.Orientation.Horizontal)
-        self.threads_slider.setMinimum(2)
-        self.threads_slider.setMaximum(6)
-        self.threads_slider.setSingleStep(1)
-        self.threads_slider.setTickInterval(1)
-        self.threads_slider.setTickPosition(QSlider.TickPosition.TicksBelow)
-        self.threads_slider.setValue(getattr(variables, "translation_threads", 1))
-        self.threads_slider.setToolTip(
-            "If you are using OpenAI for translation and have API limit restrictions, use a lower value (i.e. 2)"
+        self.in_flight_spinbox = QSpinBox()
+        self.in_flight_spinbox.setMinimum(1)
+        self.in_flight_spinbox.setMaximum(500)
+        self.in_flight_spinbox.setValue(getattr(variables, "max_in_flight", 64))
+        self.in_flight_spinbox.setToolTip(
+            "Number of translation requests waiting for a response at the same time. If you are using OpenAI and have API limit restrictions, use a lower value"
         )
-        self.threads_value_label = QLabel(str(self.threads_slider.value()))
-        self.threads_slider.valueChanged.connect(lambda v: self.threads_value_label.setText(str(v)))
-
-        threads_layout = QHBoxLayout()
-        threads_layout.addWidget(self.threads_slider)
-        threads_layout.addWidget(self.threads_value_label)
-        method_layout.addRow(QLabel("Translation Threads:"), threads_layout)
+        method_layout.addRow(QLabel("Concurrent Requests:"), self.in_flight_spinbox)
+
+        self.batch_slider = QSlider(Qt.Orientation.Horizontal)
+        self.batch_slider.setMinimum(1)
+        self.batch_slider.setMaximum(20)
+        self.batch_slider.setSingleStep(1)
+        self.batch_slider.setTickInterval(1)
+        self.batch_slider.setTickPosition(QSlider.TickPosition.TicksBelow)
+        self.batch_slider.setValue(getattr(variables, "llm_batch_size", 1))
+        self.batch_slider.setToolTip(
+            "Number of segments sent to the LLM in one request (1 = one request per segment). Larger batches save prompt tokens and requests."
+        )
+        self.batch_value_label = QLabel(str(self.batch_slider.value()))
+        self.batch_slider.valueChanged.connect(lambda v: self.batch_value_label.setText(str(v)))
+
+        batch_layout = QHBoxLayout()
+        batch_layout.addWidget(self.batch_slider)
+        batch_layout.addWidget(self.batch_value_label)
+        method_layout.addRow(QLabel("LLM Batch Size:"), batch_layout)
+
+        self.hedge_spinbox = QSpinBox()
+        self.hedge_spinbox.setMinimum(0)
+        self.hedge_spinbox.setMaximum(50)
+        self.hedge_spinbox.setSuffix("%")
+        self.hedge_spinbox.setValue(getattr(variables, "hedge_budget", 0))
+        self.hedge_spinbox.setToolTip(
+            "Requests slower than usual are sent a second time and the first response is used. The value is the maximum number of extra requests in percent (0 = off)."
+        )
+        method_layout.addRow(QLabel("Hedge Slow Requests:"), self.hedge_spinbox)
 
         method_group.setLayout(method_layout)
 
@@ -119,7 +149,9 @@ class SettingsUI(QWidget):
 
     def get_ollama_models(self):
         import requests
-        host = getattr(variables, "ollama_host", "http://localhost:11434")
+        from ollama_pool import ollama_hosts
+        hosts = ollama_hosts(self.ollama_host_input.text()) or ["http://localhost:11434"]
+        host = hosts[0]
         try:
             resp = requests.get(f"{host}/api/tags", timeout=2)
             if resp.status_code == 200:
@@ -139,13 +171,19 @@ class SettingsUI(QWidget):
         ollama_model = self.ollama_model_combo.currentText()
         default_translation = self.translation_method_combo.currentText()
         default_revision = self.revision_method_combo.currentText()
-        translation_threads = self.threads_slider.value()
+        max_in_flight = self.in_flight_spinbox.value()
+        llm_batch_size = self.batch_slider.value()
+        ollama_slots = self.ollama_slots_spinbox.value()
+        hedge_budget = self.hedge_spinbox.value()
 
         variables.default_translation = default_translation
         variables.default_revision = default_revision
-        variables.translation_threads = translation_threads
+        variables.max_in_flight = max_in_flight
+        variables.llm_batch_size = llm_batch_size
         variables.ollama_host = ollama_host
         variables.ollama_model = ollama_model
+        variables.ollama_slots = ollama_slots
+        variables.hedge_budget = hedge_budget
         variables.deepl_api = self.deepl_key_input.text()
         variables.selected_llm = provider
         variables.openAI_api = openai_api
@@ -155,10 +193,13 @@ class SettingsUI(QWidget):
             getattr(variables, "openAI_api", ""),
             default_translation,
             default_revision,
-            translation_threads,
+            max_in_flight,
             getattr(variables, "selected_llm", "OpenAI"),
             getattr(variables, "ollama_host", ""),
-            getattr(variables, "ollama_model", "")
+            getattr(variables, "ollama_model", ""),
+            llm_batch_size,
+            ollama_slots,
+            hedge_budget
         )
 
         QMessageBox.information(self, "Saved", "Settings saved successfully!")
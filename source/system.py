@@ -14,10 +14,13 @@ def load_env():
     openai_api = ""
     translation_method = "MT"
     revision_method = "MT"
-    translation_threads = 4
+    max_in_flight = 64
+    llm_batch_size = 1
+    hedge_budget = 0
     selected_llm = "OpenAI"
     ollama_host = "http://localhost:11434"
     ollama_model = ""
+    ollama_slots = 4
 
     try:
         with open(".env", "r", encoding="utf-8") as f:
@@ -33,14 +36,20 @@ def load_env():
                     translation_method = value.strip()
                 elif key == "REVISION_METHOD":
                     revision_method = value.strip()
-                elif key == "TRANSLATION_THREADS":
-                    translation_threads = int(value.strip())
+                elif key == "MAX_IN_FLIGHT":
+                    max_in_flight = int(value.strip())
+                elif key == "LLM_BATCH_SIZE":
+                    llm_batch_size = int(value.strip())
+                elif key == "HEDGE_BUDGET":
+                    hedge_budget = int(value.strip())
                 elif key == "SELECTED_LLM":
                     selected_llm = value.strip()
                 elif key == "OLLAMA_HOST":
                     ollama_host = value.strip()
                 elif key == "OLLAMA_MODEL":
                     ollama_model = value.strip()
+                elif key == "OLLAMA_SLOTS":
+                    ollama_slots = int(value.strip())
     except Exception as e:
         print(f"Failed to load .env: {e}")
         return
@@ -49,22 +58,28 @@ def load_env():
     variables.openAI_api = openai_api
     variables.default_translation = translation_method
     variables.default_revision = revision_method
-    variables.translation_threads = translation_threads
+    variables.max_in_flight = max_in_flight
+    variables.llm_batch_size = llm_batch_size
+    variables.hedge_budget = hedge_budget
     variables.selected_llm = selected_llm
     variables.ollama_host = ollama_host
     variables.ollama_model = ollama_model
+    variables.ollama_slots = ollama_slots
 
-def save_env(deepl_api, openai_api, default_translation, default_revision, translation_threads, selected_llm, ollama_host, ollama_model):
+def save_env(deepl_api, openai_api, default_translation, default_revision, max_in_flight, selected_llm, ollama_host, ollama_model, llm_batch_size=1, ollama_slots=4, hedge_budget=0):
     try:
         with open(".env", "w", encoding="utf-8") as f:
             f.write(f'DEEPL_API={base64.b64encode(deepl_api.encode()).decode()}\n')
             f.write(f'OPENAI_API={base64.b64encode(openai_api.encode()).decode()}\n')
             f.write(f'TRANSLATION_METHOD={default_translation}\n')
             f.write(f'REVISION_METHOD={default_revision}\n')
-            f.write(f'TRANSLATION_THREADS={translation_threads}\n')
+            f.write(f'MAX_IN_FLIGHT={max_in_flight}\n')
             f.write(f'SELECTED_LLM={selected_llm}\n')
             f.write(f'OLLAMA_HOST={ollama_host}\n')
             f.write(f'OLLAMA_MODEL={ollama_model}\n')
+            f.write(f'LLM_BATCH_SIZE={llm_batch_size}\n')
+            f.write(f'OLLAMA_SLOTS={ollama_slots}\n')
+            f.write(f'HEDGE_BUDGET={hedge_budget}\n')
     except Exception as e:
         print(f"Failed to save .env: {e}")
         return
@@ -0,0 +1,190 @@
+import csv, os, time, chardet
+import pandas as pd
+from collections import deque
+
+CSV_SAMPLE_SIZE = 256 * 1024
+CSV_SNIFF_LINES = 20
+CSV_DELIMITERS = ",\t;|"
+CSV_CHUNK_SIZE = 100000
+TERMBASE_LOADER_VERSION = 1
+csv_formats = {}
+
+class Termbase:
+    """Aho-Corasick automaton over the (case-folded) termbase sources.
+    Built once per run, finds every term of a segment in a single pass.
+    word_boundaries -> Only match terms that are not part of a longer word.
+    """
+
+    def __init__(self, word_boundaries: bool = False):
+        self.word_boundaries = word_boundaries
+        self.sources = []
+        self.targets = []
+        self.term_ids = {}
+        self.children = [{}]
+        self.fail = [0]
+        self.output = [-1]
+        self.output_link = [0]
+        self.built = False
+
+    @classmethod
+    def from_dataframe(cls, dataframe, source_col: str = "Source", target_col: str = "Target", word_boundaries: bool = False):
+        "Builds the automaton from a termbase dataframe."
+        termbase = cls(word_boundaries)
+        for source, target in zip(dataframe[source_col], dataframe[target_col]):
+            termbase.add(source, target)
+        termbase.build()
+        return termbase
+
+    def __len__(self):
+        return len(self.sources)
+
+    def add(self, source: str, target: str):
+        """Adds a term to the trie, the first target of a repeated source is kept.
+        build() has to be called after the last term.
+        """
+        term = source.casefold()
+        if not term or term in self.term_ids:
+            return
+        term_id = len(self.sources)
+        self.term_ids[term] = term_id
+        self.sources.append(source)
+        self.targets.append(target)
+
+        node = 0
+        for char in term:
+            next_node = self.children[node].get(char)
+            if next_node is None:
+                next_node = len(self.children)
+                self.children[node][char] = next_node
+                self.children.append({})
+                self.fail.append(0)
+                self.output.append(-1)
+                self.output_link.append(0)
+            node = next_node
+        self.output[node] = term_id
+        self.built = False
+
+    def build(self):
+        "Computes the failure and output links (breadth-first)."
+        queue = deque(self.children[0].values())
+        for node in queue:
+            self.fail[node] = 0
+            self.output_link[node] = 0
+        while queue:
+            node = queue.popleft()
+            for char, child in self.children[node].items():
+                fail_node = self.fail[node]
+                while fail_node and char not in self.children[fail_node]:
+                    fail_node = self.fail[fail_node]
+                fail_target = self.children[fail_node].get(char, 0)
+                self.fail[child] = fail_target
+                self.output_link[child] = fail_target if self.output[fail_target] != -1 else self.output_link[fail_target]
+                queue.append(child)
+        self.built = True
+
+    def matches(self, text: str):
+        """Finds all term occurrences in the text.
+        Returns a list of (start, end, term_id) in the case-folded text.
+        """
+        if not self.built:
+            self.build()
+        folded_text = text.casefold()
+        found = []
+        node = 0
+        for end, char in enumerate(folded_text, start=1):
+            while node and char not in self.children[node]:
+                node = self.fail[node]
+            node = self.children[node].get(char, 0)
+            match_node = node if self.output[node] != -1 else self.output_link[node]
+            while match_node:
+                term_id = self.output[match_node]
+                start = end - len(self.sources[term_id].casefold())
+                if not self.word_boundaries or self.is_whole_word(folded_text, start, end):
+                    found.append((start, end, term_id))
+                match_node = self.output_link[match_node]
+        return found
+
+    @staticmethod
+    def is_whole_word(text: str, start: int, end: int):
+        return (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum())
+
+    def find(self, text: str):
+        """Finds the terms of a segment, overlapping terms resolve to the longest (leftmost) one
+        and every term is listed once.
+        Returns a dictionary: start index -> {"Source", "Target"}, in order of appearance.
+        """
+        relevant_glossary = {}
+        seen_terms = set()
+        covered_until = 0
+        for start, end, term_id in sorted(self.matches(text), key=lambda match: (match[0], -match[1])):
+            if start < covered_until:
+                continue
+            covered_until = end
+            if term_id in seen_terms:
+                continue
+            seen_terms.add(term_id)
+            relevant_glossary[start] = {
+                "Source": self.sources[term_id],
+                "Target": self.targets[term_id],
+            }
+        return relevant_glossary
+
+def csv_format(csv_path: str):
+    """Detects the encoding (chardet over a bounded sample) and the delimiter (csv.Sniffer) of a csv file.
+    Cached per file, so the column dialog and the termbase loader detect it only once.
+    Returns (encoding, delimiter).
+    """
+    stat = os.stat(csv_path)
+    key = (os.path.abspath(csv_path), stat.st_size, stat.st_mtime_ns)
+    if key in csv_formats:
+        return csv_formats[key]
+
+    with open(csv_path, "rb") as f:
+        sample = f.read(CSV_SAMPLE_SIZE)
+    if len(sample) == CSV_SAMPLE_SIZE and b"\n" in sample:
+        sample = sample[:sample.rfind(b"\n") + 1]
+
+    csv_encoding = chardet.detect(sample)["encoding"] or "utf-8"
+    if csv_encoding.lower() == "ascii":
+        csv_encoding = "utf-8"
+
+    sniff_text = "\n".join(sample.decode(csv_encoding, errors="replace").splitlines()[:CSV_SNIFF_LINES])
+    try:
+        delimiter = csv.Sniffer().sniff(sniff_text, delimiters=CSV_DELIMITERS).delimiter
+    except csv.Error:
+        delimiter = ","
+
+    csv_formats[key] = (csv_encoding, delimiter)
+    return csv_encoding, delimiter
+
+def csv_columns(csv_path: str):
+    """Finds and extracts the languages column from a csv file (for termbases), only the header is read.
+    Returns language_columns as a list[str]
+    """
+    csv_encoding, delimiter = csv_format(csv_path)
+    columns = pd.read_csv(csv_path, encoding=csv_encoding, sep=delimiter, nrows=0).columns
+
+    language_def_columns = [col for col in columns if col.endswith("_Def")]
+    language_columns = [col.replace("_Def", "") for col in language_def_columns]
+
+    return language_columns
+
+def load_csv_termbase(csv_path: str, source_language: str, target_language: str, termbase: Termbase = None):
+    """Streams the source and target language columns of a csv termbase into a Termbase.
+    Returns the built Termbase.
+    """
+    if termbase is None:
+        termbase = Termbase()
+    csv_encoding, delimiter = csv_format(csv_path)
+    start_time = time.perf_counter()
+
+    chunks = pd.read_csv(csv_path, encoding=csv_encoding, encoding_errors="replace", sep=delimiter,
+                         usecols=[source_language, target_language], dtype=str, chunksize=CSV_CHUNK_SIZE)
+    for chunk in chunks:
+        chunk = chunk.dropna()
+        for source, target in zip(chunk[source_language], chunk[target_language]):
+            termbase.add(source, target)
+    termbase.build()
+
+    print(f"Loaded {len(termbase)} terms in {time.perf_counter() - start_time:.1f}s")
+    return termbase
@@ -3,7 +3,8 @@ from PyQt6.QtCore import Qt
 from datetime import datetime
 from PyQt6.QtGui import QAction, QIcon
 from PyQt6.QtWidgets import QApplication, QComboBox, QDialog, QFileDialog, QHBoxLayout, QLabel, QMainWindow, QMessageBox, QPushButton, QVBoxLayout, QWidget
-from xliff import csv_columns, csv_termbase_to_df
+from termbase import csv_columns, load_csv_termbase, TERMBASE_LOADER_VERSION
+from cache import cached_build
 from translate import TranslatorUI
 from settings_ui import SettingsUI
 from system import load_env, check_app_version
@@ -107,8 +108,14 @@ class MainUI(QMainWindow):
         elif variables.deepl_api == "" and (variables.default_revision == "MT" or variables.default_translation == "MT"):
             QMessageBox.warning(self, "Error", f"DeepL API key is not set. Please set it in the settings.")
             return
-        save_path, _ = QFileDialog.getSaveFileName(self, "Save File", "", "MQXLIFF file (*.mqxliff)")
+        if variables.trans_info["file_path"].lower().endswith(".mqxlz"):
+            save_extension, save_filter = ".mqxlz", "memoQ package (*.mqxlz)"
+        else:
+            save_extension, save_filter = ".mqxliff", "MQXLIFF file (*.mqxliff)"
+        save_path, _ = QFileDialog.getSaveFileName(self, "Save File", "", save_filter)
         if save_path:
+            if not save_path.lower().endswith(save_extension):
+                save_path += save_extension
             variables.trans_info["save_path"] = save_path
             self.translation_thread = TranslatorUI()
             self.translation_thread.show()
@@ -165,7 +172,7 @@ class LanguageSelect(QDialog):
         self.target_dropdown.addItems(language_columns)
         target_layout = QHBoxLayout()
         target_layout.addWidget(target_label)
-        target_layout.addWidget(self.dropdown2)
+        target_layout.addWidget(self.target_dropdown)
 
         accept_button = QPushButton("Accept")
         accept_button.clicked.connect(lambda : self.languages_selected(file_path))
@@ -184,7 +191,12 @@ class LanguageSelect(QDialog):
         if selected_source == selected_target:
             QMessageBox.warning(self, "Language Error", "Source and Target languages must be different.")
         else:
-            variables.trans_info["tb_df"] = csv_termbase_to_df(file_path, selected_source, selected_target)
+            QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
+            try:
+                variables.trans_info["tb"] = cached_build("tb", file_path, selected_source, selected_target, TERMBASE_LOADER_VERSION,
+                    lambda: load_csv_termbase(file_path, selected_source, selected_target))
+            finally:
+                QApplication.restoreOverrideCursor()
             self.accept()
 
 def unhandled_exception_handler(exc_type, exc_value, exc_traceback):
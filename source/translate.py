@@ -1,85 +1,294 @@
 from PyQt6.QtGui import QIcon
-import variables, pathlib, os
+import asyncio, html, variables, pathlib, os
 import pandas as pd
-from segment import is_number, check_tm, is_link
+from segment import is_number, check_tm, check_termbase, is_link, repetition_key, transfer_tags
 from machine_trans import deepl_translate, check_deepl_languages
-from llm_trans import chatGPT_improve_tm, chatGPT_translate
+from llm_trans import chatGPT_improve_tm, chatGPT_translate, chatGPT_improve_tm_batch, chatGPT_translate_batch, estimate_tokens, LLM_BATCH_TOKEN_BUDGET
 from xliff import AnalyzerThread, UpdaterThread
-from PyQt6.QtCore import QMutex, QObject, QRunnable, QThread, Qt, pyqtSignal, pyqtSlot, QThreadPool
+from translation_memory import PersistentTranslationMemory, TranslationMemory, load_tmx, TM_LOADER_VERSION
+from cache import cached_build, response_key, ResponseCache
+from engine import open_engines, close_engines
+from ollama_pool import open_ollama_pool, close_ollama_pool
+from metering import increment, Meter
+from PyQt6.QtCore import QObject, QThread, Qt, pyqtSignal
 from PyQt6.QtWidgets import QLabel, QMessageBox, QProgressBar, QPushButton, QVBoxLayout, QWidget, QApplication
 
-mutex = QMutex()
+def segment_label(segment):
+    "Segment number for the translation log, prefixed with the document name for .mqxlz packages."
+    if variables.trans_info["file_path"].lower().endswith(".mqxlz"):
+        return f"{segment.file} - {segment.segment_id}"
+    return segment.segment_id
 
-class TranslatorWorker(QRunnable):
-    def __init__(self, trans_df, index, row, append_lists, trans_completed):
-        super().__init__()
-        self.trans_df = trans_df
-        self.index = index
-        self.row = row
+class TranslatorWorker:
+    """Translates a batch of segments and copies the results to their repetitions, run as a coroutine on the event loop of TranslatorThread.
+    groups -> List of (segment, repetitions), repetitions are segments with the same repetition key, they are never sent to the engines.
+    The LLM segments of a batch are sent together (chatGPT_translate_batch, chatGPT_improve_tm_batch).
+    Translations found in the response cache are not sent again.
+    """
+    def __init__(self, groups, append_lists, trans_completed):
+        self.groups = groups
         self.append_lists = append_lists
         self.trans_completed = trans_completed
 
-    @pyqtSlot()
-    def run(self):
+    async def run(self):
         trans_function = deepl_translate if variables.default_translation == "MT" else chatGPT_translate
         trans_tm_function = deepl_translate if variables.default_revision == "MT" else chatGPT_improve_tm
         trans_type = "MT" if variables.default_translation == "MT" else "LLM"
         trans_tm_type = "MT" if variables.default_revision == "MT" else "LLM"
+        llm_translate = []
+        llm_improve = []
 
-        if is_number(self.row['Source']) or is_link(self.row['Source']):
-            self.trans_df.at[self.index, 'Translation'] = self.row['Source']
-            translated_segment = self.row['Source']
-            self.append_lists(self.row['Segment'], 'N/A', self.row['Source'], 'Translation skipped, no need to translate.') 
-            variables.trans_info['segments_skipped'] += 1
-        else:   
-            tm_match = check_tm(self.row['Source'], variables.trans_info['tm_df'])
-            if not tm_match.empty:
-                if float(tm_match['Similarity']) == 100:
-                    self.trans_df.at[self.index, 'Translation'] = tm_match['Target']
-                    self.append_lists(self.row['Segment'], f'Source Text:\n{self.row["Source"]}', tm_match['Target'], 'Translation skipped, TM match found.')
-                    variables.trans_info['tm_match'] += 1                            
-                elif float(tm_match['Similarity']) < 100 and float(tm_match['Similarity']) > 79:
-                    translated_segment, translation_log = trans_tm_function(self.row, tm_match['Target'])
-                    self.trans_df.at[self.index, 'Translation'] = translated_segment
-                    self.append_lists(self.row['Segment'], translation_log, translated_segment, f'Translated with {trans_tm_type}, 80%+ TM match.')
-                    variables.trans_info['tm_match_partial'] += 1
-                    variables.trans_info['segments_translated'] += 1
-                else:
-                    translated_segment, translation_log = trans_function(self.row)
-                    self.trans_df.at[self.index, 'Translation'] = translated_segment
-                    self.append_lists(self.row['Segment'], translation_log, translated_segment, f'Translated with {trans_type}.')
-                    variables.trans_info['segments_translated'] += 1
+        for segment, repetitions in self.groups:
+            match_type = segment.match
+            tm_target = segment.tm_target
+            if match_type == 'No match':
+                # the pre-pass can't know about translations added to the live TM during this run
+                tm_match = check_tm(segment.source, variables.trans_info['tm'])
+                if not tm_match.empty:
+                    match_type = 'Exact' if float(tm_match['Similarity']) == 100 else 'Fuzzy'
+                    tm_target = tm_match['Target']
+                    increment('tm_no_match', -1)
+                    increment('tm_match' if match_type == 'Exact' else 'tm_match_partial')
+
+            if match_type == 'Skip':
+                self.append_lists(segment_label(segment), 'N/A', segment.source, 'Translation skipped, no need to translate.') 
+                increment('segments_skipped')
+                self.finish(segment, repetitions, segment.source)
+            elif match_type == 'Exact':
+                self.append_lists(segment_label(segment), f'Source Text:\n{segment.source}', tm_target, 'Translation skipped, TM match found.')
+                self.finish(segment, repetitions, tm_target)
+            elif match_type == 'Fuzzy' and trans_tm_type == "LLM" and len(self.groups) > 1:
+                llm_improve.append((segment, repetitions, tm_target))
+            elif match_type == 'Fuzzy':
+                translated_segment, translation_log = await self.translate(trans_tm_function, trans_tm_type, segment, tm_target)
+                self.append_lists(segment_label(segment), translation_log, translated_segment, f'Translated with {trans_tm_type}, 80%+ TM match.')
+                increment('segments_translated')
+                self.finish(segment, repetitions, translated_segment)
+            elif trans_type == "LLM" and len(self.groups) > 1:
+                llm_translate.append((segment, repetitions))
             else:
-                translated_segment, translation_log = trans_function(self.row)
-                self.trans_df.at[self.index, 'Translation'] = translated_segment
-                self.append_lists(self.row['Segment'], translation_log, translated_segment, f'Translated with {trans_type}.')
-                variables.trans_info['segments_translated'] += 1
-        new_source = self.row['Source']
+                translated_segment, translation_log = await self.translate(trans_function, trans_type, segment)
+                self.append_lists(segment_label(segment), translation_log, translated_segment, f'Translated with {trans_type}.')
+                increment('segments_translated')
+                self.finish(segment, repetitions, translated_segment)
 
-        if not variables.trans_info['tm_df'].loc[variables.trans_info['tm_df']['Source'] == new_source].empty:
-            print(f"Duplicate entry found for source: {new_source}")
+        if llm_translate:
+            results = await self.translate_batch(chatGPT_translate_batch, [segment for segment, _ in llm_translate])
+            for (segment, repetitions), (translated_segment, translation_log) in zip(llm_translate, results):
+                self.append_lists(segment_label(segment), translation_log, translated_segment, f'Translated with LLM, batch of {len(llm_translate)} segments.')
+                increment('segments_translated')
+                self.finish(segment, repetitions, translated_segment)
+        if llm_improve:
+            results = await self.translate_batch(chatGPT_improve_tm_batch, [segment for segment, _, _ in llm_improve], [tm_target for _, _, tm_target in llm_improve])
+            for (segment, repetitions, _), (translated_segment, translation_log) in zip(llm_improve, results):
+                self.append_lists(segment_label(segment), translation_log, translated_segment, f'Translated with LLM, 80%+ TM match, batch of {len(llm_improve)} segments.')
+                increment('segments_translated')
+                self.finish(segment, repetitions, translated_segment)
+
+    async def translate(self, function, engine_type, segment, tm_target=None):
+        "Returns the translation and translation log of the engine function, or of the response cache."
+        key = self.cache_key(segment, engine_type, tm_target)
+        cached = self.cached_translation(key, segment)
+        if cached is not None:
+            return cached
+        if tm_target is None:
+            translated_segment, translation_log = await function(segment)
+        else:
+            translated_segment, translation_log = await function(segment, tm_target)
+        self.cache_translation(key, segment, translated_segment)
+        return translated_segment, translation_log
+
+    async def translate_batch(self, batch_function, segments, tm_targets=None):
+        "Sends the segments missing from the response cache to the LLM batch function, returns (translation, translation log) of every segment."
+        keys = [self.cache_key(segment, "LLM", tm_targets[index] if tm_targets else None) for index, segment in enumerate(segments)]
+        results = [self.cached_translation(key, segment) for key, segment in zip(keys, segments)]
+        missing = [index for index, result in enumerate(results) if result is None]
+        if not missing:
+            return results
+        if tm_targets is None:
+            translations = await batch_function([segments[index] for index in missing])
         else:
-            new_target = translated_segment
-            new_row = pd.DataFrame({'Source': [new_source], 'Target': [new_target]})
-            variables.trans_info['tm_df'] = pd.concat([variables.trans_info['tm_df'], new_row], ignore_index=True)
+            translations = await batch_function([segments[index] for index in missing], [tm_targets[index] for index in missing])
+        for index, translation in zip(missing, translations):
+            results[index] = translation
+            self.cache_translation(keys[index], segments[index], translation[0])
+        return results
+
+    def cache_key(self, segment, engine_type, tm_target=None):
+        """Returns the response cache key of a segment: engine and model, languages, masked source, TM target and context.
+        The relevant glossary is part of the key of the LLM requests, DeepL doesn't use it.
+        """
+        source_text = segment.masked()[0]
+        if engine_type == "MT":
+            engine = ["DeepL"]
+            glossary = []
+        else:
+            model = variables.openAI_model if variables.selected_llm == "OpenAI" else variables.ollama_model
+            engine = [variables.selected_llm, model]
+            glossary = sorted((info["Source"], info["Target"]) for info in check_termbase(source_text).values())
+        return response_key(engine, variables.trans_info["source_language"], variables.trans_info["target_language"],
+                            source_text, tm_target, glossary, segment.context)
+
+    def cached_translation(self, key, segment):
+        "Returns the cached translation adapted to the tags of the segment and its translation log, or None."
+        response_cache = variables.trans_info["response_cache"]
+        if response_cache is None:
+            return None
+        cached = response_cache.get(key)
+        if cached is None:
+            increment('cache_misses')
+            return None
+        increment('cache_hits')
+        translation, tags_dict = cached
+        translated_segment = transfer_tags(translation, tags_dict, segment.masked()[1])
+        return translated_segment, f"Source:\n{segment.masked()[0]}\nTranslation from the response cache:\n{translated_segment}"
+
+    def cache_translation(self, key, segment, translated_segment):
+        "Stores a successful engine translation in the response cache."
+        response_cache = variables.trans_info["response_cache"]
+        if response_cache is None or not translated_segment or translated_segment.startswith("::LLM_FAIL"):
+            return
+        response_cache.put(key, translated_segment, segment.masked()[1])
+
+    def finish(self, segment, repetitions, translated_segment):
+        "Stores the translation of a segment and copies it to its repetitions."
+        segment.translation = translated_segment
+        self.add_to_tm(segment.source, translated_segment)
         self.trans_completed()
+
+        for repetition in repetitions:
+            repeated_segment = transfer_tags(translated_segment, segment.masked()[1], repetition.masked()[1])
+            repetition.translation = repeated_segment
+            self.append_lists(segment_label(repetition), f'Source Text:\n{repetition.source}', repeated_segment, f'Repetition of segment {segment_label(segment)}.')
+            increment('segments_repeated')
+            self.add_to_tm(repetition.source, repeated_segment)
+            self.trans_completed()
+
+    def fail(self, error):
+        """Marks the segments of the batch that have no translation yet as failed, after the worker raised an error.
+        Their target stays as it is in the document.
+        """
+        for segment, repetitions in self.groups:
+            for failed_segment in [segment, *repetitions]:
+                if failed_segment.translation is not None:
+                    continue
+                failed_segment.translation = ""
+                self.append_lists(segment_label(failed_segment), f'Source Text:\n{failed_segment.source}', "", f'Translation failed: {error}')
+                increment('translation_failed')
+                self.trans_completed()
+
+    def add_to_tm(self, new_source, translated_segment):
+        if not variables.trans_info['tm'].add(new_source, translated_segment):
+            print(f"Duplicate entry found for source: {new_source}")
+        elif translated_segment and not translated_segment.startswith("::LLM_FAIL"):
+            variables.trans_info['tm_store'].add(new_source, translated_segment)
  
 
 class TranslatorObject(QObject):
     update_progress_signal = pyqtSignal(int)
     update_main_progress_signal = pyqtSignal(int)
-    translation_finished_signal = pyqtSignal()
+
+class MatcherThread(QThread):
+    """Bulk translation memory pre-pass.
+    Loads the translation memories and classifies every unlocked segment (Skip, Exact, Fuzzy, No match)
+    before any engine call, so the translation workers only wait on the engines.
+    Sets match, similarity and tm_target of every segment in the segment store.
+    A translation memory that can't be loaded is kept in error, the translation doesn't start.
+    """
+    def __init__(self, qWidget):
+        super().__init__()
+        self.translator_object = TranslatorObject()
+        self.translator_object.update_progress_signal.connect(qWidget.update_progress_bar)
+        self.translator_object.update_main_progress_signal.connect(qWidget.update_main_progress_bar)
+        self.qWidget = qWidget
+        self.error = None
+
+    def run(self):
+        variables.trans_info["current_step"] += 1
+        self.qWidget.main_progress_label.setText(f"Matching Translation Memory - {variables.trans_info["current_step"]}/{variables.trans_info["total_steps"]}")
+        main_progress = variables.trans_info["current_step"]/variables.trans_info["total_steps"]*100
+        self.translator_object.update_main_progress_signal.emit(int(main_progress))
+
+        source_language = variables.trans_info["source_language"]
+        target_language = variables.trans_info["target_language"]
+        variables.trans_info["tm_store"] = None
+        try:
+            variables.trans_info["tm_store"] = PersistentTranslationMemory.open(source_language, target_language)
+            self.match_segments(source_language, target_language)
+        except asyncio.CancelledError:
+            print("Translation memory matching cancelled.")
+            return
+        except Exception as e:
+            print(f"Translation memory loading failed: {e}")
+            self.error = e
+            if variables.trans_info["tm_store"] is not None:
+                variables.trans_info["tm_store"].close()
+            return
+        self.translator_object.update_progress_signal.emit(100)
+
+    def match_segments(self, source_language, target_language):
+        "Loads the translation memories and matches the segments, raises asyncio.CancelledError when the thread is interrupted."
+        tm_path = variables.trans_info["tm_path"]
+        if tm_path:
+            self.qWidget.sub_progress_label.setText("Loading translation memory...")
+            variables.trans_info["tm"] = cached_build("tm", tm_path, source_language, target_language, TM_LOADER_VERSION,
+                lambda: load_tmx(tm_path, source_language, target_language, progress_callback=self.load_progress)[0])
+        else:
+            variables.trans_info["tm"] = TranslationMemory()
+        self.qWidget.sub_progress_label.setText("Matching segments with translation memory...")
+
+        segments = variables.trans_info["segments"].unlocked()
+        translation_memories = [variables.trans_info["tm"], variables.trans_info["tm_store"]]
+        segment_matches = {}
+        match_types = []
+        progress_update_treshold = 0
+
+        for completed, segment in enumerate(segments, start=1):
+            if self.isInterruptionRequested():
+                raise asyncio.CancelledError()
+            if segment.source not in segment_matches:
+                segment_matches[segment.source] = self.match_segment(segment.source, translation_memories)
+            segment.match, segment.similarity, segment.tm_target = segment_matches[segment.source]
+            match_types.append(segment.match)
+            progress = completed / len(segments) * 100
+            if progress > progress_update_treshold + 5:
+                self.translator_object.update_progress_signal.emit(round(progress))
+                progress_update_treshold += 5
+
+        variables.trans_info["tm_match"] = match_types.count("Exact")
+        variables.trans_info["tm_match_partial"] = match_types.count("Fuzzy")
+        variables.trans_info["tm_no_match"] = match_types.count("No match")
+        print(f"TM leverage: {variables.trans_info['tm_match']} exact, {variables.trans_info['tm_match_partial']} fuzzy, {variables.trans_info['tm_no_match']} no match")
+
+    def load_progress(self, progress):
+        "Progress callback of load_tmx, a cancelled run stops the load (the partial memory is not cached)."
+        if self.isInterruptionRequested():
+            raise asyncio.CancelledError()
+        self.translator_object.update_progress_signal.emit(progress)
+
+    def match_segment(self, source, translation_memories):
+        "Returns (match type, similarity, TM target) of a segment."
+        if is_number(source) or is_link(source):
+            return "Skip", 0.0, ""
+        tm_match = check_tm(source, translation_memories)
+        if tm_match.empty:
+            return "No match", 0.0, ""
+        similarity = float(tm_match["Similarity"])
+        return ("Exact" if similarity == 100 else "Fuzzy"), similarity, tm_match["Target"]
 
 class TranslatorThread(QThread):
+    """Runs the translation workers as coroutines on an asyncio event loop owned by this thread.
+    Waiting for an engine response or a retry doesn't hold a thread, up to variables.max_in_flight
+    workers and engine requests are active at once. Progress reaches the UI through the TranslatorObject signals.
+    """
     def __init__(self, qWidget):
         super().__init__()
         self.translator_object = TranslatorObject()
         self.translator_object.update_progress_signal.connect(qWidget.update_progress_bar)
         self.translator_object.update_main_progress_signal.connect(qWidget.update_main_progress_bar)
-        self.translator_object.translation_finished_signal.connect(qWidget.start_writing_mqxliff)
         self.qWidget = qWidget     
-        self.threadpool = QThreadPool.globalInstance()
-        self.threadpool.setMaxThreadCount(variables.translation_threads)
+        self.loop = None
+        self.main_task = None
 
     def run(self):
         self.segment_numbers = []
@@ -95,33 +304,105 @@ class TranslatorThread(QThread):
             self.translation_details.append(translation_detail)
             self.version_list.append("")
             
-        self.trans_df = variables.trans_info["mqxliff_df"]
-        self.trans_df = self.trans_df[self.trans_df['Locked'] == 'Null']
-        self.segments = self.trans_df['Source']
+        self.segments = variables.trans_info["segments"].unlocked()
 
         self.translation_length = len(self.segments)
-        self.current_translation = 1
+        self.current_translation = 0
         self.progress = 0
         variables.trans_info["current_step"] += 1
         self.qWidget.main_progress_label.setText(f"Translating - {variables.trans_info["current_step"]}/{variables.trans_info["total_steps"]}")
         main_progress = variables.trans_info["current_step"]/variables.trans_info["total_steps"]*100
         self.translator_object.update_main_progress_signal.emit(int(main_progress))
 
-        for index, row in self.trans_df.iterrows():
-            worker = TranslatorWorker(self.trans_df, index, row, append_lists, self.trans_completed)
-            self.threadpool.start(worker)   
+        repetition_groups = {}
+        for segment in self.segments:
+            repetition_groups.setdefault(repetition_key(segment.masked()[0]), []).append(segment)
+
+        groups = [(segment, repetitions) for segment, *repetitions in repetition_groups.values()]
+        variables.trans_info["response_cache"] = ResponseCache.open()
+        variables.trans_info["meter"] = Meter()
+        try:
+            asyncio.run(self.translate(self.batches(groups), append_lists))
+        except asyncio.CancelledError:
+            print("Translation cancelled.")
+            return
+        finally:
+            variables.trans_info['tm_store'].close()
+            variables.trans_info["response_cache"].close()
+            variables.trans_info["response_cache"] = None
+
+        self.save_translation_log(self.segment_numbers, self.translation_logs, self.translation_results, self.translation_details, self.version_list)
+        self.translator_object.update_progress_signal.emit(100)  
+
+    async def translate(self, batches, append_lists):
+        "Runs the batches with max_in_flight concurrent workers, a worker takes the next batch when it's done."
+        self.loop = asyncio.get_running_loop()
+        self.main_task = asyncio.current_task()
+        if self.isInterruptionRequested():
+            raise asyncio.CancelledError()
+
+        async def run_workers():
+            for batch in batches:
+                worker = TranslatorWorker(batch, append_lists, self.trans_completed)
+                try:
+                    await worker.run()
+                except Exception as e:
+                    print(f"Translation of segment {segment_label(batch[0][0])} failed: {e}")
+                    worker.fail(e)
+
+        open_engines(variables.max_in_flight)
+        try:
+            if variables.selected_llm == "Ollama" and "LLM" in (variables.default_translation, variables.default_revision):
+                await open_ollama_pool()
+            await asyncio.gather(*(run_workers() for _ in range(variables.max_in_flight)))
+        finally:
+            close_ollama_pool()
+            await close_engines()
+            self.loop = None
+
+    def requestInterruption(self):
+        "Also cancels the running workers, their pending engine requests and retries are cancelled with them."
+        super().requestInterruption()
+        loop, main_task = self.loop, self.main_task
+        if loop is not None and main_task is not None:
+            try:
+                loop.call_soon_threadsafe(main_task.cancel)
+            except RuntimeError:
+                pass  # the loop has already finished
+
+    def batches(self, groups):
+        """Packs the segments that go to the LLM into batches of up to variables.llm_batch_size segments
+        and LLM_BATCH_TOKEN_BUDGET estimated tokens. Every other segment is a batch of its own.
+        """
+        batch_size = variables.llm_batch_size
+        open_batches = {"No match": ([], 0), "Fuzzy": ([], 0)}
+        llm_matches = set()
+        if variables.default_translation == "LLM":
+            llm_matches.add("No match")
+        if variables.default_revision == "LLM":
+            llm_matches.add("Fuzzy")
+
+        for group in groups:
+            segment = group[0]
+            if batch_size <= 1 or segment.match not in llm_matches:
+                yield [group]
+                continue
+            tokens = estimate_tokens(segment.masked()[0]) + estimate_tokens(segment.tm_target)
+            batch, batch_tokens = open_batches[segment.match]
+            if batch and (len(batch) >= batch_size or batch_tokens + tokens > LLM_BATCH_TOKEN_BUDGET):
+                yield batch
+                batch, batch_tokens = [], 0
+            batch.append(group)
+            open_batches[segment.match] = (batch, batch_tokens + tokens)
+
+        for batch, _ in open_batches.values():
+            if batch:
+                yield batch
 
     def trans_completed(self):
-        mutex.lock()
         self.current_translation += 1
         self.progress = (self.current_translation / self.translation_length) * 100
         self.translator_object.update_progress_signal.emit(int(self.progress))
-        mutex.unlock()
-        if self.current_translation == self.translation_length:
-            variables.trans_info['mqxliff_df'] = self.trans_df
-            self.save_translation_log(self.segment_numbers, self.translation_logs, self.translation_results, self.translation_details, self.version_list)
-            self.translator_object.update_progress_signal.emit(100)  
-            self.translator_object.translation_finished_signal.emit()
 
     def save_translation_log(self, segment_numbers, translation_logs, translation_results, translation_details, version_list):
         translation_log = {'Segment' : segment_numbers,
@@ -140,6 +421,7 @@ class TranslatorThread(QThread):
         file_name = variables.trans_info['file_name']
         file_path = os.path.join(full_temp_dir, f"{file_name}-Machine_Translation.xlsx")
         translation_log_df.to_excel(file_path)
+        variables.trans_info["meter"].write_report(os.path.join(full_temp_dir, f"{file_name}-Usage_Report.json"), self.segments)
         
   
 class TranslatorUI(QWidget):
@@ -159,6 +441,8 @@ class TranslatorUI(QWidget):
         self.cancel_button = QPushButton("Cancel")
         self.cancel_button.setVisible(True)
         self.cancel_button.clicked.connect(self.cancel_process)
+        # QThread clears its interruption request when it finishes, the next stage checks this flag
+        self.cancelled = False
 
         main_layout.addWidget(self.main_progress_label)
         main_layout.addWidget(self.main_progress_bar)
@@ -177,13 +461,13 @@ class TranslatorUI(QWidget):
             target_language_okay = check_deepl_languages(False, variables.trans_info["target_language"])
             source_language_okay = check_deepl_languages(True, variables.trans_info["source_language"])
             if target_language_okay and target_language_okay:
-                self.start_machine_translation()
+                self.start_tm_matching()
             elif not source_language_okay:
                 self.translation_language_error(True)      
             elif not target_language_okay:
                 self.translation_language_error(False)                
         else:
-            self.start_machine_translation()
+            self.start_tm_matching()
 
     def update_progress_bar(self, progress):
         QApplication.processEvents()  
@@ -193,12 +477,29 @@ class TranslatorUI(QWidget):
         QApplication.processEvents()  
         self.main_progress_bar.setValue(progress)
 
+    def start_tm_matching(self):
+        if self.cancelled:
+            return
+        self.current_thread = MatcherThread(self)
+        self.current_thread.finished.connect(self.start_machine_translation)
+        self.current_thread.start()
+
     def start_machine_translation(self):
+        if self.cancelled:
+            if variables.trans_info["tm_store"] is not None:
+                variables.trans_info["tm_store"].close()
+            return
+        if self.current_thread.error is not None:
+            self.translation_memory_error(self.current_thread.error)
+            return
         self.sub_progress_label.setText("Translating segments...")
         self.current_thread = TranslatorThread(self)
+        self.current_thread.finished.connect(self.start_writing_mqxliff)
         self.current_thread.start()
 
     def start_writing_mqxliff(self):
+        if self.cancelled:
+            return
         variables.trans_info["current_step"] += 1
         self.main_progress_label.setText(f"Writing MQXLIFF - {variables.trans_info["current_step"]}/{variables.trans_info["total_steps"]}")
         self.current_thread = UpdaterThread(self)
@@ -206,8 +507,11 @@ class TranslatorUI(QWidget):
 
     def translation_finished(self):
         error_message = f"""Segments translated: {variables.trans_info["segments_translated"]}
+                            \nTM matches: {variables.trans_info["tm_match"]} exact, {variables.trans_info["tm_match_partial"]} fuzzy
+                            \nRepetitions: {variables.trans_info["segments_repeated"]}
                             \nSegments skipped: {variables.trans_info["segments_skipped"]}
-                            \nFailed translations: {variables.trans_info["translation_failed"]}"""
+                            \nFailed translations: {variables.trans_info["translation_failed"]}
+                            \nResponse cache: {variables.trans_info["cache_hits"]} hits, {variables.trans_info["cache_misses"]} misses"""
         msg_box = QMessageBox(self)
         msg_box.setWindowTitle(f"Translation Finished")
         msg_box.setTextFormat(Qt.TextFormat.RichText)
@@ -231,8 +535,21 @@ class TranslatorUI(QWidget):
         msg_box.exec()
         self.close()
 
+    def translation_memory_error(self, error):
+        tm_path = variables.trans_info["tm_path"]
+        tm_name = f" ({html.escape(os.path.basename(tm_path))})" if tm_path else ""
+        error_message = f"The translation memory{tm_name} could not be loaded, the translation was not started.<br><br>{html.escape(str(error))}"
+        msg_box = QMessageBox(self)
+        msg_box.setWindowTitle(f"Translation Memory Error")
+        msg_box.setTextFormat(Qt.TextFormat.RichText)
+        msg_box.setText(error_message)
+        msg_box.setStandardButtons(QMessageBox.StandardButton.Ok)
+        msg_box.setTextInteractionFlags(Qt.TextInteractionFlag.TextBrowserInteraction)
+        msg_box.exec()
+        self.close()
 
     def cancel_process(self):
+            self.cancelled = True
             if hasattr(self, "current_thread") and self.current_thread is not None:
                 if isinstance(self.current_thread, QThread):
                     self.current_thread.requestInterruption()
@@ -241,8 +558,4 @@ class TranslatorUI(QWidget):
                 elif hasattr(self.current_thread, "terminate"):
                     self.current_thread.terminate()
                     self.current_thread.wait()
-            try:
-                QThreadPool.globalInstance().clear()
-            except AttributeError:
-                pass
             self.close()
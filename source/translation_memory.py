@@ -0,0 +1,479 @@
+from array import array
+from collections import Counter, defaultdict
+import math, os, re, sqlite3, threading, time
+import numpy as np
+import lxml.etree as etree
+from segment import lev_distance, lev_distance_batch
+
+GRAM_SIZE = 3
+CANDIDATE_LIMIT = 32
+BATCH_MIN_CANDIDATES = 64
+SHORT_SEGMENT_LENGTH = 24
+STOP_GRAM_RATIO = 0.05
+XML_LANG = "{http://www.w3.org/XML/1998/namespace}lang"
+TM_STORE_DIR = "_temp/translation_memory"
+RARE_GRAM_BUDGET = 20000
+SQL_VARIABLE_LIMIT = 900
+TM_LOADER_VERSION = 1
+
+TM_STORE_SCHEMA = """
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = NORMAL;
+CREATE TABLE IF NOT EXISTS units (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    target TEXT NOT NULL,
+    source_key TEXT NOT NULL UNIQUE,
+    length INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS units_length ON units (length);
+CREATE VIRTUAL TABLE IF NOT EXISTS units_fts USING fts5 (
+    source, content = 'units', content_rowid = 'id', tokenize = 'trigram case_sensitive 1', detail = none
+);
+CREATE TABLE IF NOT EXISTS gram_counts (
+    gram TEXT PRIMARY KEY,
+    doc INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+def new_id_array():
+    return array("I")
+
+def extract_grams(text: str, gram_size: int = GRAM_SIZE):
+    "Returns the set of padded character n-grams of a segment."
+    padding = "\x02" * (gram_size - 1)
+    padded = f"{padding}{text}{padding}"
+    return {padded[i:i + gram_size] for i in range(len(padded) - gram_size + 1)}
+
+def normalize_source(text: str):
+    "Normalizes whitespace so sources that only differ in spacing share one exact-match key."
+    return re.sub(r"\s+", " ", text).strip()
+
+def fuzzy_percent(segment: str, candidate: str, distance: int):
+    "Converts an edit distance into the fuzzy match percent used by check_tm."
+    max_length = max(len(segment), len(candidate))
+    if max_length == 0:
+        return 0
+    return float(1.0 - distance / max_length) * 100
+
+def length_window(length: int, threshold: int = 80):
+    "Returns the (min, max) candidate length that can still be above the threshold."
+    ratio = threshold / 100
+    return math.floor(length * ratio) + 1, math.ceil(length / ratio) - 1
+
+def score_candidates(segment: str, sources: list, threshold: int = 80):
+    """Scores candidate sources against the segment with the bounded edit distance kernels.
+    Many candidates are scored at once with the NumPy kernel, a few one by one with a bound
+    that tightens as better matches are found.
+    Returns (index of the best source, similarity) or None if no source is above the threshold.
+    """
+    if not sources:
+        return None
+
+    best_index = None
+    best_similarity = threshold
+    if len(sources) >= BATCH_MIN_CANDIDATES:
+        max_distance = math.ceil((1 - threshold / 100) * max(len(segment), max(map(len, sources)))) - 1
+        if max_distance < 0:
+            return None
+        distances = lev_distance_batch(segment, sources, max_distance).tolist()
+    else:
+        distances = None
+
+    for index, source in enumerate(sources):
+        if distances is None:
+            # only distances that beat the current best are worth computing
+            max_distance = math.ceil((1 - best_similarity / 100) * max(len(source), len(segment))) - 1
+            if max_distance < 0:
+                continue
+            distance = lev_distance(source, segment, max_distance)
+        else:
+            distance = distances[index]
+        if distance > max_distance:
+            continue
+        similarity = fuzzy_percent(segment, source, distance)
+        if similarity > best_similarity:
+            best_index = index
+            best_similarity = similarity
+
+    if best_index is None:
+        return None
+    return best_index, best_similarity
+
+def similarity_bounds(length: int, candidate_lengths, min_distances):
+    """Returns the highest fuzzy match percent each candidate can still reach (numpy array), from a lower bound
+    of its edit distance (min_distances) and the length difference, which is a lower bound too.
+    """
+    candidate_lengths = np.asarray(candidate_lengths, dtype=np.int64)
+    min_distances = np.maximum(np.asarray(min_distances, dtype=np.int64), np.abs(candidate_lengths - length))
+    return (1 - min_distances / np.maximum(candidate_lengths, max(length, 1))) * 100
+
+def score_ranked(segment: str, unit_ids: list, bounds: list, sources_of, threshold: int = 80):
+    """Scores candidates ranked by the highest similarity they can reach (similarity_bounds), best first.
+    The first CANDIDATE_LIMIT are scored, then twice as many each round, until no remaining candidate
+    can beat the best match. Returns the same best match as scoring every candidate.
+    sources_of -> Function that returns the sources of a list of unit ids.
+    Returns (unit id of the best match, similarity) or None if no candidate is above the threshold.
+    """
+    best_unit_id = None
+    best_similarity = threshold
+    start = 0
+    round_size = CANDIDATE_LIMIT
+    while start < len(unit_ids) and bounds[start] > best_similarity:
+        chunk = unit_ids[start:start + round_size]
+        best_match = score_candidates(segment, sources_of(chunk), best_similarity)
+        if best_match is not None:
+            best_unit_id = chunk[best_match[0]]
+            best_similarity = best_match[1]
+        start += round_size
+        round_size *= 2
+
+    if best_unit_id is None:
+        return None
+    return best_unit_id, best_similarity
+
+class TranslationMemory:
+    """In-memory translation memory with a character n-gram inverted index.
+    Fuzzy lookups only score the units that pass the length-ratio and shared n-gram
+    count filters, most promising first, until no other unit can beat the best match.
+    Units are append-only: adds are serialized with a lock, lookups work on a
+    snapshot (the units that existed when the lookup started) and never block scoring.
+    """
+
+    def __init__(self, gram_size: int = GRAM_SIZE):
+        self.gram_size = gram_size
+        self.lock = threading.Lock()
+        self.sources = []
+        self.targets = []
+        self.lengths = array("I")
+        self.exact_index = {}
+        self.postings = defaultdict(new_id_array)
+        self.length_index = defaultdict(new_id_array)
+
+    @classmethod
+    def from_dataframe(cls, dataframe, source_col: str = "Source", target_col: str = "Target"):
+        "Builds a translation memory from a pandas dataframe."
+        tm = cls()
+        for source, target in zip(dataframe[source_col], dataframe[target_col]):
+            tm.add(source, target)
+        return tm
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __contains__(self, source):
+        return normalize_source(source) in self.exact_index
+
+    def add(self, source: str, target: str):
+        """Adds a translation unit to the memory and the index.
+        Returns False if the (whitespace normalized) source is already in the memory.
+        """
+        source_key = normalize_source(source)
+        grams = extract_grams(source, self.gram_size)
+        with self.lock:
+            if source_key in self.exact_index:
+                return False
+            unit_id = len(self.sources)
+            self.lengths.append(len(source))
+            self.length_index[len(source)].append(unit_id)
+            for gram in grams:
+                self.postings[gram].append(unit_id)
+            self.targets.append(target)
+            self.sources.append(source)
+            self.exact_index[source_key] = unit_id
+        return True
+
+    def candidates(self, segment: str, threshold: int = 80):
+        """Finds the units that can reach the threshold against the segment.
+        Returns a list of unit ids and the highest similarity each one can reach (similarity_bounds), best first.
+        """
+        size = len(self.sources)
+        length = len(segment)
+        ratio = threshold / 100
+        if size == 0 or length == 0 or ratio <= 0:
+            return [], []
+
+        # similarity > threshold is impossible outside this length window
+        min_length, max_length = length_window(length, threshold)
+        max_distance = max(math.ceil((1 - ratio) * max_length) - 1, 0)
+
+        grams = extract_grams(segment, self.gram_size)
+        # every edit destroys at most gram_size grams of the segment
+        required = len(grams) - self.gram_size * max_distance
+
+        # short segments share too few grams for the count filter, score the whole length window
+        if required <= 0 and length <= SHORT_SEGMENT_LENGTH:
+            unit_ids = []
+            with self.lock:
+                for candidate_length in range(min_length, max_length + 1):
+                    unit_ids.extend(unit_id for unit_id in self.length_index.get(candidate_length, ()) if unit_id < size)
+                lengths = np.array([self.lengths[unit_id] for unit_id in unit_ids], dtype=np.int64)
+            unit_ids = np.array(unit_ids, dtype=np.int64)
+            bounds = similarity_bounds(length, lengths, np.zeros(len(unit_ids)))
+        else:
+            stop_limit = max(int(size * STOP_GRAM_RATIO), 1000)
+            postings = []
+            skipped = 0
+            # copy the postings under the lock, an add can't resize them while numpy reads the buffers
+            with self.lock:
+                for gram in grams:
+                    posting = self.postings.get(gram)
+                    if posting is None:
+                        continue
+                    if len(posting) > stop_limit:
+                        skipped += 1
+                        continue
+                    postings.append(np.array(posting, dtype=np.uint32))
+                lengths = np.array(self.lengths[:size], dtype=np.int64)
+
+            # ids added after the snapshot are cut off by the [:size] slice
+            posting_ids = np.concatenate(postings) if postings else np.empty(0, dtype=np.uint32)
+            shared = np.bincount(posting_ids, minlength=size)[:size]
+            unit_ids = np.flatnonzero((shared >= required - skipped) & (lengths >= min_length) & (lengths <= max_length))
+            # the skipped stop grams may be shared too
+            missing = np.maximum(len(grams) - skipped - shared[unit_ids], 0)
+            bounds = similarity_bounds(length, lengths[unit_ids], np.ceil(missing / self.gram_size))
+
+        keep = bounds > threshold
+        unit_ids, bounds = unit_ids[keep], bounds[keep]
+        best_first = np.argsort(-bounds, kind="stable")
+        return unit_ids[best_first].tolist(), bounds[best_first].tolist()
+
+    def lookup(self, segment: str, threshold: int = 80):
+        """Finds the best fuzzy match for the segment.
+        Returns (source, target, similarity) or None if no unit is above the threshold.
+        """
+        unit_id = self.exact_index.get(normalize_source(segment))
+        if unit_id is not None and self.sources[unit_id] == segment and segment:
+            return self.sources[unit_id], self.targets[unit_id], 100.0
+
+        unit_ids, bounds = self.candidates(segment, threshold)
+        best_match = score_ranked(segment, unit_ids, bounds, lambda chunk: [self.sources[unit_id] for unit_id in chunk], threshold)
+        if best_match is None:
+            return None
+        unit_id, similarity = best_match
+        return self.sources[unit_id], self.targets[unit_id], similarity
+
+class PersistentTranslationMemory:
+    """Translation memory stored in a SQLite file, one file per language pair.
+    Every unit is appended in its own transaction together with its FTS5 trigram
+    index entries and trigram document counts, so the index grows with the store
+    and opening it is instant.
+    Same lookup/add interface as TranslationMemory.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.executescript(TM_STORE_SCHEMA)
+
+    @classmethod
+    def open(cls, source_language: str, target_language: str, directory: str = TM_STORE_DIR):
+        "Opens (or creates) the store of a language pair."
+        os.makedirs(directory, exist_ok=True)
+        file_name = f"{normalize_locale(source_language)}_{normalize_locale(target_language)}.sqlite"
+        return cls(os.path.join(directory, file_name))
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COALESCE(MAX(id), 0) FROM units").fetchone()[0]
+
+    def __contains__(self, source):
+        with self.lock:
+            row = self.connection.execute("SELECT 1 FROM units WHERE source_key = ?", (normalize_source(source),)).fetchone()
+        return row is not None
+
+    def add(self, source: str, target: str):
+        """Appends a translation unit to the store and the index in one transaction.
+        Returns False if the (whitespace normalized) source is already in the store.
+        """
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO units (source, target, source_key, length) VALUES (?, ?, ?, ?)",
+                (source, target, normalize_source(source), len(source)),
+            )
+            if cursor.rowcount == 0:
+                return False
+            self.connection.execute("INSERT INTO units_fts (rowid, source) VALUES (?, ?)", (cursor.lastrowid, source))
+            self.connection.executemany(
+                "INSERT INTO gram_counts (gram, doc) VALUES (?, 1) ON CONFLICT (gram) DO UPDATE SET doc = doc + 1",
+                ((gram,) for gram in {source[i:i + GRAM_SIZE] for i in range(len(source) - GRAM_SIZE + 1)}),
+            )
+        return True
+
+    def candidates(self, segment: str, threshold: int = 80):
+        """Finds the units that can reach the threshold against the segment.
+        Only the rarest non-overlapping trigrams of the segment are queried, always enough of them
+        that every unit above the threshold shares at least one.
+        Returns a list of unit ids and the highest similarity each one can reach (similarity_bounds), best first.
+        """
+        length = len(segment)
+        ratio = threshold / 100
+        if length == 0 or ratio <= 0:
+            return [], []
+        min_length, max_length = length_window(length, threshold)
+        max_distance = max(math.ceil((1 - ratio) * max_length) - 1, 0)
+        # every edit touches at most one of the non-overlapping grams
+        grams = {segment[i:i + GRAM_SIZE] for i in range(0, length - GRAM_SIZE + 1, GRAM_SIZE)}
+
+        with self.lock:
+            # segments with too few grams for the count filter score the whole length window
+            if len(grams) <= max_distance:
+                rows = self.connection.execute(
+                    "SELECT id, length FROM units WHERE length BETWEEN ? AND ?", (min_length, max_length)
+                ).fetchall()
+                unit_ids = np.array([unit_id for unit_id, _ in rows], dtype=np.int64)
+                bounds = similarity_bounds(length, [unit_length for _, unit_length in rows], np.zeros(len(rows)))
+            else:
+                doc_counts = dict(self.connection.execute(
+                    f"SELECT gram, doc FROM gram_counts WHERE gram IN ({', '.join('?' * len(grams))})", list(grams)
+                ).fetchall())
+                shared = Counter()
+                posting_count = 0
+                queried = 0
+                # grams no unit has cost nothing, the first max_distance + 1 grams are queried whatever they cost
+                for gram in sorted(grams, key=lambda gram: doc_counts.get(gram, 0)):
+                    doc_count = doc_counts.get(gram, 0)
+                    if queried > max_distance and posting_count + doc_count > RARE_GRAM_BUDGET:
+                        break
+                    if doc_count:
+                        query = '"' + gram.replace('"', '""') + '"'
+                        shared.update(row[0] for row in self.connection.execute("SELECT rowid FROM units_fts WHERE units_fts MATCH ?", (query,)))
+                    posting_count += doc_count
+                    queried += 1
+
+                # a unit above the threshold misses at most max_distance of the queried grams
+                shared_ids = [unit_id for unit_id, count in shared.items() if count >= queried - max_distance]
+                rows = []
+                for start in range(0, len(shared_ids), SQL_VARIABLE_LIMIT):
+                    chunk = shared_ids[start:start + SQL_VARIABLE_LIMIT]
+                    rows.extend(self.connection.execute(
+                        f"SELECT id, length FROM units WHERE id IN ({', '.join('?' * len(chunk))}) AND length BETWEEN ? AND ?",
+                        chunk + [min_length, max_length],
+                    ))
+                unit_ids = np.array([unit_id for unit_id, _ in rows], dtype=np.int64)
+                missing = [queried - shared[unit_id] for unit_id, _ in rows]
+                bounds = similarity_bounds(length, [unit_length for _, unit_length in rows], missing)
+
+        keep = bounds > threshold
+        unit_ids, bounds = unit_ids[keep], bounds[keep]
+        best_first = np.argsort(-bounds, kind="stable")
+        return unit_ids[best_first].tolist(), bounds[best_first].tolist()
+
+    def sources(self, unit_ids: list):
+        "Returns the sources of the units, in the order of unit_ids."
+        sources = {}
+        with self.lock:
+            for start in range(0, len(unit_ids), SQL_VARIABLE_LIMIT):
+                chunk = unit_ids[start:start + SQL_VARIABLE_LIMIT]
+                sources.update(self.connection.execute(
+                    f"SELECT id, source FROM units WHERE id IN ({', '.join('?' * len(chunk))})", chunk
+                ))
+        return [sources[unit_id] for unit_id in unit_ids]
+
+    def lookup(self, segment: str, threshold: int = 80):
+        """Finds the best fuzzy match for the segment.
+        Returns (source, target, similarity) or None if no unit is above the threshold.
+        """
+        with self.lock:
+            exact = self.connection.execute(
+                "SELECT source, target FROM units WHERE source_key = ?", (normalize_source(segment),)
+            ).fetchone()
+        if exact is not None and exact[0] == segment and segment:
+            return exact[0], exact[1], 100.0
+
+        unit_ids, bounds = self.candidates(segment, threshold)
+        best_match = score_ranked(segment, unit_ids, bounds, self.sources, threshold)
+        if best_match is None:
+            return None
+        unit_id, similarity = best_match
+        with self.lock:
+            source, target = self.connection.execute("SELECT source, target FROM units WHERE id = ?", (unit_id,)).fetchone()
+        return source, target, similarity
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+def normalize_locale(locale: str):
+    "Normalizes locale codes (en_US, EN-us...) to en-us."
+    return (locale or "").strip().lower().replace("_", "-")
+
+def locale_matches(document_locale: str, tmx_locale: str):
+    """Checks if a TMX locale can be used for a document locale.
+    Region-less codes match any region of the same language (en <-> en-us).
+    """
+    document_locale = normalize_locale(document_locale)
+    tmx_locale = normalize_locale(tmx_locale)
+    if document_locale == tmx_locale:
+        return True
+    document_parts = document_locale.split("-")
+    tmx_parts = tmx_locale.split("-")
+    if document_parts[0] != tmx_parts[0]:
+        return False
+    return len(document_parts) == 1 or len(tmx_parts) == 1
+
+def load_tmx(tmx_path: str, source_language: str, target_language: str, tm: TranslationMemory = None, progress_callback=None):
+    """Streams a TMX file into a translation memory.
+    Only tu elements with a non-empty seg for both the source and target locale are added.
+    Parsed elements are cleared right away so memory stays bounded for very large files.
+    progress_callback -> Optional function called with the percent of the file read.
+    Returns the translation memory and a dictionary with the load statistics.
+    """
+    if tm is None:
+        tm = TranslationMemory()
+
+    file_size = os.path.getsize(tmx_path) or 1
+    units_read = 0
+    units_added = 0
+    progress_update_treshold = 0
+    start_time = time.perf_counter()
+
+    with open(tmx_path, "rb") as tmx_file:
+        for _, tu in etree.iterparse(tmx_file, events=("end",), tag="tu", huge_tree=True):
+            units_read += 1
+            source = None
+            target = None
+            for tuv in tu.iterchildren("tuv"):
+                tuv_locale = tuv.get(XML_LANG) or tuv.get("lang")
+                seg = tuv.find("seg")
+                if seg is None:
+                    continue
+                if source is None and locale_matches(source_language, tuv_locale):
+                    source = "".join(seg.itertext())
+                elif target is None and locale_matches(target_language, tuv_locale):
+                    target = "".join(seg.itertext())
+
+            if source and target and tm.add(source, target):
+                units_added += 1
+
+            tu.clear(keep_tail=True)
+            while tu.getprevious() is not None:
+                del tu.getparent()[0]
+
+            if progress_callback is not None:
+                progress = tmx_file.tell() / file_size * 100
+                if progress > progress_update_treshold + 5:
+                    progress_callback(round(progress))
+                    progress_update_treshold += 5
+
+    elapsed = max(time.perf_counter() - start_time, 1e-9)
+    stats = {
+        "units_read" : units_read,
+        "units_added" : units_added,
+        "seconds" : elapsed,
+        "units_per_second" : units_read / elapsed,
+        "mb_per_second" : file_size / elapsed / 1024 / 1024,
+    }
+    print(f"Loaded {units_added}/{units_read} TMX units in {elapsed:.1f}s ({stats['units_per_second']:.0f} units/s, {stats['mb_per_second']:.1f} MB/s)")
+    return tm, stats
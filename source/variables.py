@@ -1,4 +1,3 @@
-import pandas as pd
 import os
 
 trans_version = "v1.0.1"
@@ -10,24 +9,37 @@ trans_info = {
     "save_path" : None,
     "source_language" : None,
     "target_language" : None,
-    "mqxliff_df" : None,
+    "segments" : None,
+    "mqxliff_index" : None,
     "tm_path" : None,
-    "tm_df" : pd.DataFrame(columns=['Source', 'Target']),
+    "tm" : None,
+    "tm_store" : None,
     "tb_path" : None,
-    "tb_df" : pd.DataFrame(),
+    "tb" : None,
+    "response_cache" : None,
+    "meter" : None,
+    "request_slots" : None,
+    "engines" : None,
+    "ollama_pool" : None,
     "segments_translated" : 0,
     "tm_match" : 0,
     "tm_match_partial" : 0,
+    "tm_no_match" : 0,
     "segments_skipped" : 0,
+    "segments_repeated" : 0,
     "translation_failed" : 0,
+    "cache_hits" : 0,
+    "cache_misses" : 0,
     "token_count" : 0,
-    "total_steps" : 3,
+    "total_steps" : 4,
     "current_step" : 0,
     }
 
 trans_save = None
 deepl_api = ""
-translation_threads = 4
+max_in_flight = 64
+llm_batch_size = 1
+hedge_budget = 0
 default_translation = "MT"
 default_revision = "MT"
 openAI_api = ""
@@ -35,6 +47,7 @@ openAI_model = "gpt-4.1-mini"
 selected_llm = "OpenAI"
 ollama_host = "http://localhost:11434"
 ollama_model = ""
+ollama_slots = 4
 
 language_locale = {
     "ko_kr": "Korean",
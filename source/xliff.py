@@ -1,14 +1,259 @@
-import re, chardet, string, variables, zipfile, os
-import pandas as pd
+import io, mmap, re, shutil, variables, zipfile, os
 import lxml.etree as etree
 from segment import create_memoq_elements_dict
+from segment_store import Segment, SegmentStore
 from PyQt6.QtCore import QObject, QThread, pyqtSignal
 from PyQt6.QtWidgets import QApplication
 
-def extract_mqxliff(mqxlz_path, extract_to="_temp/extracted_mqxliff"):
-    with zipfile.ZipFile(mqxlz_path, 'r') as zip_ref:
-        zip_ref.extractall(extract_to)
-    return [os.path.join(extract_to, f) for f in os.listdir(extract_to) if f.endswith('.mqxliff')]
+XLIFF_NS = "{urn:oasis:names:tc:xliff:document:1.2}"
+MEMOQ_TAG_SPLIT_REGEX = re.compile(r"(<(?:mq|st|tw|bpt|ept|it|ph):[^>]+?\/?>|<\/(?:mq|st|tw|bpt|ept|it|ph):[^>]+?>|<(?:mq|st|tw|bpt|ept|it|ph):[^>]+?>|<.+?>|{})")
+MEMOQ_TAG_REGEX = re.compile(r"(<(?:mq|st|tw|bpt|ept|it|ph):.+?\s*/>)|(<\/(?:mq|st|tw|bpt|ept|it|ph):.+?>)|(<(?:mq|st|tw|bpt|ept|it|ph):.+?>)|<.+?>|{}", re.DOTALL)
+UNIT_ID_REGEX = re.compile(rb'\sid="([^"]*)"')
+COPY_BLOCK_SIZE = 1024 * 1024
+
+def is_mqxlz(file_path: str):
+    return file_path.lower().endswith(".mqxlz")
+
+def package_documents(package: zipfile.ZipFile):
+    "Returns the ZipInfo of every MQXLIFF document in an .mqxlz package."
+    return [info for info in package.infolist() if info.filename.lower().endswith(".mqxliff")]
+
+def copy_zip_info(info: zipfile.ZipInfo):
+    "Returns a new ZipInfo with the name, date, compression and attributes of a package member."
+    output_info = zipfile.ZipInfo(info.filename, info.date_time)
+    output_info.compress_type = info.compress_type
+    output_info.external_attr = info.external_attr
+    output_info.comment = info.comment
+    return output_info
+
+def scaled_progress(progress_callback, offset: int, size: int, total_size: int):
+    "Maps the progress of one document of a package to the progress of the whole package."
+    return lambda progress: progress_callback(round((offset + size * progress / 100) / (total_size or 1) * 100))
+
+class UnitIndex:
+    """Byte spans of the trans-units of an MQXLIFF file, collected by the analyzer.
+    The writer copies everything outside the translated units straight from the source
+    instead of parsing the document again.
+    """
+
+    def __init__(self, namespaces: dict):
+        self.file_path = None
+        self.file_signature = None
+        self.declarations = namespace_declarations(namespaces)
+        self.segment_ids = []
+        self.spans = []
+
+    def bind(self, file_path: str):
+        "Records the file the spans belong to."
+        stat = os.stat(file_path)
+        self.file_path = file_path
+        self.file_signature = (stat.st_size, stat.st_mtime_ns)
+
+    def is_valid_for(self, file_path: str):
+        "Returns True if the index was built from this (unchanged) file."
+        if self.file_path is None or os.path.abspath(file_path) != os.path.abspath(self.file_path) or not os.path.exists(file_path):
+            return False
+        stat = os.stat(file_path)
+        return (stat.st_size, stat.st_mtime_ns) == self.file_signature
+
+def normalize_tag_text(text: str):
+    return text.strip().replace("&", "&amp")
+
+def create_tag_lookup(source_element):
+    """Indexes the memoQ inline elements of a source element by their normalized text.
+    Returns a dictionary: normalized text -> list of (element type, attributes).
+    """
+    tag_lookup = {}
+    for key, value in create_memoq_elements_dict(source_element).items():
+        element_type, _ = key.split("_", 1)
+        tag_lookup.setdefault(normalize_tag_text(value["text"]), []).append((element_type, value["attributes"]))
+    return tag_lookup
+
+def write_target(target_element, source_element, translation: str):
+    """Writes a translation into a target element, memoQ tags in the translation are
+    converted back into the inline elements of the source element.
+    """
+    tag_lookup = create_tag_lookup(source_element)
+    for part in MEMOQ_TAG_SPLIT_REGEX.split(translation.lstrip()):
+        if part:
+            if MEMOQ_TAG_REGEX.match(part.replace("\n", "")):
+                try:
+                    for element_type, attributes in tag_lookup.get(normalize_tag_text(part), ()):
+                        element = etree.SubElement(target_element, element_type, attributes)
+                        element.text = part.replace("&", "&amp")
+                    if target_element.tail is None:
+                        target_element.tail = ""
+
+                except etree.XMLSyntaxError as e:
+                    print(f"Error (XMLSyntaxError): {e} - matched_string: {part}")
+            else:
+                if len(target_element) > 0:
+                    last_element = target_element[-1]
+                    if last_element.tail is None:
+                        last_element.tail = part
+                    else:
+                        last_element.tail += part
+                else:
+                    target_element.text = part
+
+def apply_translation(trans_unit, translations: dict):
+    "Writes the translation of a trans-unit (if any) into its target element."
+    trans_id = int(trans_unit.get("id"))
+    if trans_id in translations:
+        df_target_text = translations[trans_id]
+        df_target_text = str(df_target_text) if df_target_text is not None else ""
+
+        target_element = trans_unit.find(f"{XLIFF_NS}target")
+        source_element = trans_unit.find(f"{XLIFF_NS}source")
+
+        if target_element != None:
+            write_target(target_element, source_element, df_target_text)
+
+def namespace_declarations(nsmap: dict):
+    "Returns the serialized namespace declarations of a namespace map."
+    return [(f' xmlns="{uri}"' if prefix is None else f' xmlns:{prefix}="{uri}"').encode("utf-8") for prefix, uri in nsmap.items()]
+
+def serialize_unit(trans_unit, inherited_declarations: list):
+    """Serializes a trans-unit without the namespace declarations it inherits from its ancestors,
+    these are already declared on the enclosing elements of the output.
+    """
+    serialized = etree.tostring(trans_unit, encoding="utf-8", with_tail=False)
+    start_tag_end = serialized.index(b">")
+    start_tag = serialized[:start_tag_end]
+    for declaration in inherited_declarations:
+        start_tag = start_tag.replace(declaration, b"", 1)
+    return start_tag + serialized[start_tag_end:]
+
+def write_mqxliff(source_file, output_file, translations: dict, source_size: int = 0, progress_callback=None):
+    """Streams an MQXLIFF document from source_file to output_file and writes the translations into
+    the trans-units on the way. Every trans-unit is written as soon as it is parsed and then
+    released, so memory stays flat and the output grows while the document is read.
+    translations -> Dictionary: segment id -> translation.
+    progress_callback -> Optional function called with the percent of the source read.
+    """
+    source_size = source_size or 1
+    progress_update_treshold = 0
+    open_elements = []
+    trans_unit = None
+    pending = None
+
+    with etree.xmlfile(output_file, encoding="utf-8") as xf:
+        xf.write_declaration()
+
+        # Text and tails are only complete at the next parser event, they are written one event late.
+        def write_pending():
+            element, kind = pending
+            if kind == "text":
+                if element.text:
+                    xf.write(element.text)
+            else:
+                if element.tail and open_elements:
+                    xf.write(element.tail)
+                element.clear(keep_tail=False)
+                if element.getparent() is not None:
+                    while element.getprevious() is not None:
+                        del element.getparent()[0]
+
+        for event, element in etree.iterparse(source_file, events=("start", "end", "comment", "pi"), strip_cdata=False, huge_tree=True):
+            if trans_unit is not None:
+                if event == "end" and element is trans_unit:
+                    apply_translation(trans_unit, translations)
+                    xf.flush()
+                    output_file.write(serialize_unit(trans_unit, open_elements[-1][2]))
+                    pending = (trans_unit, "tail")
+                    trans_unit = None
+
+                    progress = source_file.tell() / source_size * 100
+                    if progress_callback is not None and progress > progress_update_treshold + 5:
+                        progress_callback(int(progress))
+                        progress_update_treshold += 5
+                continue
+
+            if pending is not None:
+                write_pending()
+                pending = None
+
+            if event == "start":
+                if element.tag == f"{XLIFF_NS}trans-unit":
+                    trans_unit = element
+                    continue
+                parent_nsmap = open_elements[-1][0].nsmap if open_elements else {}
+                nsmap = {prefix: uri for prefix, uri in element.nsmap.items() if parent_nsmap.get(prefix) != uri}
+                context = xf.element(element.tag, dict(element.attrib), nsmap)
+                context.__enter__()
+                open_elements.append((element, context, namespace_declarations(element.nsmap)))
+                pending = (element, "text")
+            elif event == "end":
+                _, context, _ = open_elements.pop()
+                context.__exit__(None, None, None)
+                pending = (element, "tail")
+            else:
+                xf.write(element, with_tail=False)
+                pending = (element, "tail")
+
+def needs_update(translation):
+    "Returns True if writing the translation changes the target element."
+    return translation is not None and str(translation).lstrip() != ""
+
+def copy_bytes(data, output_file, start: int, end: int):
+    for block_start in range(start, end, COPY_BLOCK_SIZE):
+        output_file.write(data[block_start:min(block_start + COPY_BLOCK_SIZE, end)])
+
+def write_indexed_mqxliff(data, output_file, translations: dict, unit_index: UnitIndex, progress_callback=None):
+    """Writes the translations into an MQXLIFF document using the trans-unit spans found by the analyzer.
+    Only the units with a translation are parsed and serialized again, all other bytes are copied
+    from the source unchanged.
+    data -> The raw bytes of the source document (bytes or mmap).
+    """
+    parser = etree.XMLParser(strip_cdata=False, huge_tree=True)
+    wrapper_start = b"<unit-wrapper" + b"".join(unit_index.declarations) + b">"
+    position = 0
+    progress_update_treshold = 0
+
+    for segment_id, (start, end) in zip(unit_index.segment_ids, unit_index.spans):
+        if not needs_update(translations.get(segment_id)):
+            continue
+        copy_bytes(data, output_file, position, start)
+        trans_unit = etree.fromstring(wrapper_start + data[start:end] + b"</unit-wrapper>", parser)[0]
+        apply_translation(trans_unit, translations)
+        output_file.write(serialize_unit(trans_unit, unit_index.declarations))
+        position = end
+
+        progress = end / (len(data) or 1) * 100
+        if progress_callback is not None and progress > progress_update_treshold + 5:
+            progress_callback(int(progress))
+            progress_update_treshold += 5
+    copy_bytes(data, output_file, position, len(data))
+
+def write_mqxlz(package_path: str, output_path: str, translations: dict, unit_indexes: dict, progress_callback=None):
+    """Writes a translated copy of an .mqxlz package from zip to zip, without extracting it.
+    The MQXLIFF documents get their translations, all other files are copied as they are.
+    translations -> Dictionary: document name -> {segment id -> translation}.
+    unit_indexes -> Dictionary: document name -> UnitIndex (or None) from the analyzer.
+    """
+    with zipfile.ZipFile(package_path) as package, zipfile.ZipFile(output_path, "w") as output_package:
+        document_names = {info.filename for info in package_documents(package)}
+        total_size = sum(info.file_size for info in package.infolist() if info.filename in document_names)
+        written_size = 0
+        for info in package.infolist():
+            large_file = info.file_size > 1 << 30
+            with output_package.open(copy_zip_info(info), "w", force_zip64=large_file) as output_file:
+                if info.filename not in document_names:
+                    with package.open(info) as source_file:
+                        shutil.copyfileobj(source_file, output_file, COPY_BLOCK_SIZE)
+                    continue
+
+                document_translations = translations.get(info.filename, {})
+                unit_index = unit_indexes.get(info.filename)
+                document_progress = None
+                if progress_callback is not None:
+                    document_progress = scaled_progress(progress_callback, written_size, info.file_size, total_size)
+                if unit_index is not None and unit_index.is_valid_for(package_path):
+                    write_indexed_mqxliff(package.read(info), output_file, document_translations, unit_index, document_progress)
+                else:
+                    with package.open(info) as source_file:
+                        write_mqxliff(source_file, output_file, document_translations, info.file_size, document_progress)
+                written_size += info.file_size
 
 class AnalyzerObject(QObject):
     update_progress_signal = pyqtSignal(int)
@@ -25,63 +270,139 @@ class AnalyzerThread(QThread):
 
     def run(self):
         file_path = variables.trans_info["file_path"]
+        progress_callback = self.analyzer_object.update_progress_signal.emit
 
-        parser = etree.XMLParser(strip_cdata=False)
-        if file_path.endswith(".mqxliff"):
-            tree = etree.parse(file_path, parser)
-        else:
-            file_path = extract_mqxliff(file_path)[0]
-            tree = etree.parse(file_path, parser)
-        root = tree.getroot()
-        rows = []
-    
-        for file_elem in root.iter("{urn:oasis:names:tc:xliff:document:1.2}file"):
-            original_file = file_elem.get("original", "404 not found")
-            source_language = file_elem.get("source-language", "404 not found")
-            variables.trans_info["source_language"] = source_language
-            target_language = file_elem.get("target-language", "404 not found")
-            variables.trans_info["target_language"] = target_language
-        if source_language == "404 not found" or target_language == "404 not found":
-            raise ValueError(f"Error: Source language and/or target language element not found in the document: {original_file}")  
-    
-        analysis_length = sum(1 for _ in root.iter('{urn:oasis:names:tc:xliff:document:1.2}trans-unit'))       
-        completed_analysis = 0
-        progress_update_treshold = 0
         variables.trans_info["current_step"] += 1
         self.qWidget.main_progress_label.setText(f"Analyzing MQXLIFF - {variables.trans_info["current_step"]}/{variables.trans_info["total_steps"]}")
         main_progress = variables.trans_info["current_step"] / variables.trans_info["total_steps"] * 100
         self.analyzer_object.update_main_progress_signal.emit(round(main_progress))
 
-        for trans_unit in root.iter("{urn:oasis:names:tc:xliff:document:1.2}trans-unit"):
-            trans_id = trans_unit.get("id")
-            is_locked = trans_unit.get("{MQXliff}locked", "Null")       
-            source_element = trans_unit.find("{urn:oasis:names:tc:xliff:document:1.2}source")
-            target_element = trans_unit.find("{urn:oasis:names:tc:xliff:document:1.2}target")
-            note_elem = trans_unit.find("{urn:oasis:names:tc:xliff:document:1.2}note")
+        segments = SegmentStore()
+        unit_indexes = {}
+        if is_mqxlz(file_path):
+            # Every document of the package is read straight from the zip, they share one job (TM, termbase, repetitions).
+            with zipfile.ZipFile(file_path) as package:
+                documents = package_documents(package)
+                if not documents:
+                    raise ValueError(f"Error: No MQXLIFF document found in the package: {file_path}")
+                total_size = sum(info.file_size for info in documents)
+                analyzed_size = 0
+                language_pair = None
+                for info in documents:
+                    data = package.read(info)
+                    document_segments, unit_indexes[info.filename] = analyze_mqxliff(io.BytesIO(data), data, info.file_size, info.filename,
+                                                                               scaled_progress(progress_callback, analyzed_size, info.file_size, total_size))
+                    if language_pair is not None and language_pair != (variables.trans_info["source_language"], variables.trans_info["target_language"]):
+                        raise ValueError(f"Error: {info.filename} has a different language pair than the other documents of the package.")
+                    language_pair = (variables.trans_info["source_language"], variables.trans_info["target_language"])
+                    segments.extend(document_segments)
+                    analyzed_size += info.file_size
+        else:
+            document_name = os.path.basename(file_path)
+            with open(file_path, "rb") as mqxliff_file:
+                data = mmap.mmap(mqxliff_file.fileno(), 0, access=mmap.ACCESS_READ)
+                document_segments, unit_indexes[document_name] = analyze_mqxliff(mqxliff_file, data, os.path.getsize(file_path), document_name, progress_callback)
+                segments.extend(document_segments)
+                data.close()
 
-            if source_element is not None and target_element is not None:
-                source = "".join(source_element.itertext())
-                target = "".join(target_element.itertext())
-            else:
-                source = "Null"
-                target = "Null"
-            if note_elem is not None:
-                note_text = "".join(note_elem.itertext())
-            else:
-                note_text = ""
-
-            rows.append({"Segment": int(trans_id),"Source": source, "Target": target, "Locked" : is_locked, "Context" : note_text})
-            completed_analysis += 1
-            progress = (completed_analysis / analysis_length) * 100 
-            if progress > progress_update_treshold + 5:
-                self.analyzer_object.update_progress_signal.emit(round(progress))
-                progress_update_treshold += 5
-
-        analyzed_df = pd.DataFrame(rows)
-        analyzed_df.reset_index(drop=True, inplace=True)
-        variables.trans_info['mqxliff_df'] = analyzed_df
+        for unit_index in unit_indexes.values():
+            if unit_index is not None:
+                unit_index.bind(file_path)
+
+        variables.trans_info['segments'] = segments
+        variables.trans_info['mqxliff_index'] = unit_indexes
         self.analyzer_object.update_progress_signal.emit(100)
 
+def analyze_mqxliff(mqxliff_file, data, file_size: int, document_name: str, progress_callback=None):
+    """Reads the segments of an MQXLIFF document in a single streaming pass.
+    data -> The raw bytes of the document (bytes or mmap), scanned for the byte spans of the trans-units.
+    document_name -> File name of the document, segments are keyed by file + segment id.
+    progress_callback -> Optional function called with the percent of the file read.
+    Returns the list of Segments and a UnitIndex, or None if the spans could not be matched
+    with the parsed units (the writer then falls back to a full streaming pass).
+    """
+    segments = []
+    unit_index = None
+    unit_spans = find_unit_spans(data)
+    source_language = target_language = original_file = "404 not found"
+    progress_update_treshold = 0
+
+    units = etree.iterparse(mqxliff_file, events=("start", "end"), tag=(f"{XLIFF_NS}file", f"{XLIFF_NS}trans-unit"), strip_cdata=False, huge_tree=True)
+    for event, element in units:
+        if element.tag == f"{XLIFF_NS}file":
+            if event == "start":
+                original_file = element.get("original", "404 not found")
+                source_language = element.get("source-language", "404 not found")
+                variables.trans_info["source_language"] = source_language
+                target_language = element.get("target-language", "404 not found")
+                variables.trans_info["target_language"] = target_language
+            continue
+        if event == "start":
+            if not segments:
+                unit_index = UnitIndex(element.getparent().nsmap) if is_utf8(element) else None
+            continue
+
+        trans_unit = element
+        trans_id = trans_unit.get("id")
+        is_locked = trans_unit.get("{MQXliff}locked", "Null")
+        source_element = trans_unit.find(f"{XLIFF_NS}source")
+        target_element = trans_unit.find(f"{XLIFF_NS}target")
+        note_elem = trans_unit.find(f"{XLIFF_NS}note")
+
+        if source_element is not None and target_element is not None:
+            source = "".join(source_element.itertext())
+            target = "".join(target_element.itertext())
+        else:
+            source = "Null"
+            target = "Null"
+        if note_elem is not None:
+            note_text = "".join(note_elem.itertext())
+        else:
+            note_text = ""
+
+        segments.append(Segment(document_name, int(trans_id), source, target, is_locked, note_text))
+
+        if unit_index is not None:
+            span = next(unit_spans, None)
+            if span is None or span[0] != trans_id.encode("utf-8"):
+                unit_index = None
+            else:
+                unit_index.segment_ids.append(int(trans_id))
+                unit_index.spans.append(span[1:])
+
+        trans_unit.clear(keep_tail=True)
+        while trans_unit.getprevious() is not None:
+            del trans_unit.getparent()[0]
+
+        progress = mqxliff_file.tell() / (file_size or 1) * 100
+        if progress_callback is not None and progress > progress_update_treshold + 5:
+            progress_callback(round(progress))
+            progress_update_treshold += 5
+
+    if source_language == "404 not found" or target_language == "404 not found":
+        raise ValueError(f"Error: Source language and/or target language element not found in the document: {original_file}")
+    if unit_index is not None and next(unit_spans, None) is not None:
+        unit_index = None
+    return segments, unit_index
+
+def find_unit_spans(data):
+    "Yields (id, start, end) for every trans-unit element in the raw bytes of a document."
+    position = data.find(b"<trans-unit")
+    while position != -1:
+        tag_end = data.find(b">", position)
+        end = data.find(b"</trans-unit>", tag_end)
+        if tag_end == -1 or end == -1:
+            return
+        end += len(b"</trans-unit>")
+        if data[position + len(b"<trans-unit")] in b" \t\r\n>":
+            id_match = UNIT_ID_REGEX.search(data, position, tag_end)
+            yield (id_match.group(1) if id_match else None), position, end
+        position = data.find(b"<trans-unit", end)
+
+def is_utf8(element):
+    encoding = element.getroottree().docinfo.encoding or "UTF-8"
+    return encoding.replace("-", "").lower() == "utf8"
+
 class UpdaterThread(QThread):
     def __init__(self, qWidget):
         super().__init__()
@@ -91,122 +412,34 @@ class UpdaterThread(QThread):
         self.analyzer_object.update_main_progress_signal.connect(self.qWidget.update_main_progress_bar)
         self.analyzer_object.process_finished_signal.connect(self.qWidget.translation_finished)
 
-    def run(self):   
-        dataframe = variables.trans_info["mqxliff_df"]
+    def run(self):
         file_path = variables.trans_info["file_path"]
         save_path = variables.trans_info["save_path"]
-        parser = etree.XMLParser(strip_cdata=False)
-        tree = etree.parse(file_path, parser)  
-        root = tree.getroot()
-
-        df_length = sum(1 for _ in root.iter('{urn:oasis:names:tc:xliff:document:1.2}trans-unit'))       
-        completed_segments = 0
-        progress_update_treshold = 0
 
         main_progress = variables.trans_info["current_step"] / variables.trans_info["total_steps"] * 100
         self.analyzer_object.update_main_progress_signal.emit(round(main_progress))
 
-        namespaces = root.nsmap
-        memoq_regex = r"(<(?:mq|st|tw|bpt|ept|it|ph):[^>]+?\/?>|<\/(?:mq|st|tw|bpt|ept|it|ph):[^>]+?>|<(?:mq|st|tw|bpt|ept|it|ph):[^>]+?>|<.+?>|{})"
-   
-        for trans_unit in root.iter("{urn:oasis:names:tc:xliff:document:1.2}trans-unit"):
-            trans_id = trans_unit.get("id")
-        
-            match_row = dataframe[dataframe["Segment"] == int(trans_id)]
-            if not match_row.empty:                
-                df_target_text = match_row["Translation"].iloc[0]  
-                df_target_text = str(df_target_text) if not pd.isna(df_target_text) else ""
-
-                target_element = trans_unit.find("{urn:oasis:names:tc:xliff:document:1.2}target", namespaces)
-                source_element = trans_unit.find("{urn:oasis:names:tc:xliff:document:1.2}source")
-            
-                if target_element != None:
-                    edited_target = df_target_text.lstrip() 
-                    elements_dict = create_memoq_elements_dict(source_element)
-                    parts = re.split(memoq_regex, edited_target)
-                    for part in parts:
-                        if part: 
-                            cleaned_part = part.replace("\n", "")
-                            if re.match(r"(<(?:mq|st|tw|bpt|ept|it|ph):.+?\s*/>)|(<\/(?:mq|st|tw|bpt|ept|it|ph):.+?>)|(<(?:mq|st|tw|bpt|ept|it|ph):.+?>)|<.+?>|{}", cleaned_part, re.DOTALL):
-                                try:
-                                    for key, value in elements_dict.items():
-                                        normalized_part = part.strip().replace("&", "&amp")
-                                        normalized_value_text = value["text"].strip().replace("&", "&amp")
-                                        if normalized_part == normalized_value_text:
-                                            element_type, element_id = key.split("_", 1)
-                                            element = etree.Element(element_type)
-                                            if value["attributes"]:
-                                                for attr_name, attr_value in value["attributes"].items():
-                                                    element.set(attr_name, attr_value)
-                                            element.text = part.replace("&", "&amp")
-                                            target_element.append(element)
-                                    if target_element.tail is None:
-                                        target_element.tail = "" 
-
-                                except etree.XMLSyntaxError as e:
-                                    print(f"Error (XMLSyntaxError): {e} - matched_string: {part}")
-                            else:
-                                if len(target_element) > 0:
-                                    last_element = target_element[-1]
-                                    if last_element.tail is None:
-                                        last_element.tail = part  
-                                    else:
-                                        last_element.tail += part 
-                                else:
-                                    target_element.text = part         
-            completed_segments += 1
-            progress = (completed_segments / df_length) * 100 
-            if progress > progress_update_treshold + 5:
-                self.analyzer_object.update_progress_signal.emit(int(progress))
-                progress_update_treshold += 5
-
-        with open(save_path, "wb") as doc:
-            doc.write(etree.tostring(root))
-        self.analyzer_object.update_progress_signal.emit(int(100))
-        self.analyzer_object.process_finished_signal.emit()
-
-def csv_termbase_to_df(csv_path: str, source_language: str, target_language: str):
-    """Converts a cvs termbase into a pandas dataframe.
-    csv_path: Path to termbase file.
-    source_language: Source language to be retrieved.
-    target_language: Target_language to be retrieved.
-    Returns a pandas dataframe.
-    """
+        translations = variables.trans_info["segments"].translations()
+        unit_indexes = variables.trans_info["mqxliff_index"] or {}
+        progress_callback = self.analyzer_object.update_progress_signal.emit
 
-    with open(csv_path, "rb") as f:
-        result = chardet.detect(f.read())
-        csv_encoding = result["encoding"]
-    
-    try:
-        df = pd.read_csv(csv_path, encoding=csv_encoding)
-    except pd.errors.ParserError:
-        df = pd.read_csv(csv_path, encoding=csv_encoding, delimiter="\t")
-
-    termbase_df = df.loc[:, [source_language, target_language]].rename(columns={
-        source_language: "Source",
-        target_language: "Target",
-    })
-    
-    termbase_df = termbase_df.dropna()   
-    termbase_df = termbase_df.astype(str)
-    
-    return termbase_df
-
-def csv_columns(csv_path: string):
-    """Finds and extracts the languages column from a csv file (for termbases).
-    Returns language_columns as a list[str]
-    """
+        # The source is still being read while the output is written, overwriting it needs a temporary file.
+        overwrite = os.path.abspath(save_path) == os.path.abspath(file_path)
+        output_path = f"{save_path}.part" if overwrite else save_path
+        if is_mqxlz(file_path):
+            write_mqxlz(file_path, output_path, translations, unit_indexes, progress_callback)
+        else:
+            document_name = os.path.basename(file_path)
+            document_translations = translations.get(document_name, {})
+            unit_index = unit_indexes.get(document_name)
+            with open(file_path, "rb") as source_file, open(output_path, "wb") as output_file:
+                if unit_index is not None and unit_index.is_valid_for(file_path):
+                    with mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        write_indexed_mqxliff(data, output_file, document_translations, unit_index, progress_callback)
+                else:
+                    write_mqxliff(source_file, output_file, document_translations, os.path.getsize(file_path), progress_callback)
+        if overwrite:
+            os.replace(output_path, save_path)
 
-    with open(csv_path, "rb") as f:
-        result = chardet.detect(f.read())
-        csv_encoding = result["encoding"]
-    try:
-        df = pd.read_csv(csv_path, encoding=csv_encoding)
-    except pd.errors.ParserError:
-        df = pd.read_csv(csv_path, encoding=csv_encoding, delimiter="\t")
-        
-    language_def_columns = [col for col in df.columns if col.endswith("_Def")]
-
-    language_columns = [col.replace("_Def", "") for col in language_def_columns]
-    
-    return language_columns
\ No newline at end of file
+        self.analyzer_object.update_progress_signal.emit(int(100))
+        self.analyzer_object.process_finished_signal.emit()
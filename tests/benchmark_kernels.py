@@ -0,0 +1,52 @@
+"""Benchmarks the kernels of source/segment.py (edit distance, tag codec) against the reference implementations (reference_kernels.py).
+Usage: python tests/benchmark_kernels.py [number of segments for the reference distance, default 60]
+"""
+import math, random, sys, time
+from conftest import TEST_DOCUMENT
+from reference_kernels import reference_lev_distance, reference_create_tag_dict, reference_restore_tags, document_sources, tagged_segment
+from segment import lev_distance, lev_distance_batch, create_tag_dict, restore_tags
+from translation_memory import length_window
+
+def timed(function):
+    start_time = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start_time
+
+def benchmark_edit_distance(reference_segments: int):
+    sources = document_sources(TEST_DOCUMENT)
+    subset = sources[:reference_segments]
+    print(f"Edit distance, {TEST_DOCUMENT} ({len(sources)} segments)")
+
+    reference, reference_time = timed(lambda: [reference_lev_distance(s1, s2) for s1 in subset for s2 in subset])
+    full, full_time = timed(lambda: [lev_distance(s1, s2) for s1 in subset for s2 in subset])
+    assert full == reference
+    print(f"  {len(subset)}x{len(subset)} pairs: reference {reference_time:.2f}s, bit-parallel {full_time:.2f}s")
+
+    def bounded(s1, s2):
+        # the bound of an 80% fuzzy match
+        return lev_distance(s1, s2, math.ceil(0.2 * max(len(s1), len(s2))) - 1)
+    _, bounded_time = timed(lambda: [bounded(s1, s2) for s1 in sources for s2 in sources])
+    print(f"  {len(sources)}x{len(sources)} pairs bounded at 80%: bit-parallel {bounded_time:.2f}s")
+
+    def batch():
+        # the translation memory scores the candidates of the length window at once
+        for segment in sources:
+            min_length, max_length = length_window(len(segment))
+            candidates = [source for source in sources if min_length <= len(source) <= max_length]
+            lev_distance_batch(segment, candidates, math.ceil(0.2 * max_length) - 1)
+    _, batch_time = timed(batch)
+    print(f"  {len(sources)} segments against the sources of their 80% length window: NumPy batch {batch_time:.2f}s")
+
+def benchmark_tag_codec():
+    print("Tag masking and restoring, 2000 synthetic memoQ segments")
+    rnd = random.Random(1)
+    for tags in (2, 20, 100):
+        segments = [tagged_segment(rnd, tags) for _ in range(2000)]
+        for label, mask, restore in (("reference", reference_create_tag_dict, reference_restore_tags), ("TagCodec", create_tag_dict, restore_tags)):
+            masked, mask_time = timed(lambda: [mask(segment) for segment in segments])
+            _, restore_time = timed(lambda: [restore(*masked_segment) for masked_segment in masked])
+            print(f"  {tags:3d} tags/segment {label:>9}: mask {mask_time * 1e6 / len(segments):7.1f} us, restore {restore_time * 1e6 / len(segments):7.1f} us")
+
+if __name__ == "__main__":
+    benchmark_edit_distance(int(sys.argv[1]) if len(sys.argv) > 1 else 60)
+    benchmark_tag_codec()
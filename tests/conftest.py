@@ -0,0 +1,6 @@
+import os, sys
+
+# the application modules are flat modules in source/ and import each other by name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "source"))
+
+TEST_DOCUMENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_document.mqxliff")
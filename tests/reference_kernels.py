@@ -0,0 +1,81 @@
+"""Reference implementations the optimized kernels of source/segment.py are checked and benchmarked against:
+the plain dynamic programming Levenshtein distance and the tag functions as they were before TagCodec.
+"""
+import html, random, re
+import lxml.etree as etree
+
+XLIFF_NS = "{urn:oasis:names:tc:xliff:document:1.2}"
+TAG_KINDS = ['<bpt id="{i}">&lt;b&gt;</bpt>', '<ept id="{i}">&lt;/b&gt;</ept>', '<ph id="{i}">&lt;br/&gt;</ph>',
+             '<mq:ch val="&#9;" />', '<it pos="open" id="{i}">&lt;hlnk href="x"&gt;</it>']
+MEMOQ_REGEX = r"<\/?(tw:it|st:it|mq:nt|mq:it|mq:ch|mq:gap|mq:rxt-req|mq:rxt|mq:txml-ut|mq:pi|bpt|ept|ph|it)(\s[^>]*)?>"
+
+def reference_lev_distance(s1: str, s2: str):
+    "Levenshtein distance with the full dynamic programming table, one row at a time."
+    if len(s1) < len(s2):
+        return reference_lev_distance(s2, s1)
+
+    if len(s2) == 0:
+        return len(s1)
+
+    previous_row = range(len(s2) + 1)
+    for i, c1 in enumerate(s1):
+        current_row = [i + 1]
+        for j, c2 in enumerate(s2):
+            insertions = previous_row[j + 1] + 1
+            deletions = current_row[j] + 1
+            substitutions = previous_row[j] + (c1 != c2)
+            current_row.append(min(insertions, deletions, substitutions))
+        previous_row = current_row
+
+    return previous_row[-1]
+
+def reference_create_tag_dict(segment: str):
+    "Masks the memoQ tags with <UTAG{n}/> placeholders, returns the segment and the tags dictionary."
+    tags_dict = {}
+    tag_counter = 1
+
+    def replace_tag(match):
+        nonlocal tag_counter
+        unique_tag = f"<UTAG{tag_counter}/>"
+        tags_dict[unique_tag] = html.unescape(match.group(0))
+        tag_counter += 1
+        return unique_tag
+
+    cleaned_text = re.sub(MEMOQ_REGEX, replace_tag, segment)
+    return cleaned_text, tags_dict
+
+def reference_restore_tags(cleaned_text: str, tags_dict: dict):
+    "Restores the placeholders one str.replace pass per tag, in placeholder number order."
+    def extract_number(tag):
+        match = re.search(r"\d+", tag)
+        if match:
+            return int(match.group())
+        else:
+            return float("inf")
+
+    for unique_tag in sorted(tags_dict.keys(), key=extract_number):
+        cleaned_text = cleaned_text.replace(unique_tag, tags_dict[unique_tag])
+    return cleaned_text
+
+def document_sources(mqxliff_path: str, with_tags: bool = False):
+    """Returns the source segments of an MQXLIFF document.
+    with_tags -> The serialized source content with its memoQ tags (bpt, ept, ph...) instead of its text.
+    """
+    sources = []
+    for _, source_element in etree.iterparse(mqxliff_path, events=("end",), tag=f"{XLIFF_NS}source"):
+        if with_tags:
+            content = etree.tostring(source_element, encoding="unicode", with_tail=False)
+            content = content[content.index(">") + 1:content.rindex("</")] if not content.endswith("/>") else ""
+            sources.append(re.sub(r' xmlns(:\w+)?="[^"]*"', "", content))
+        else:
+            sources.append("".join(source_element.itertext()))
+    return sources
+
+def tagged_segment(rnd: random.Random, tags: int):
+    "Returns a synthetic memoQ segment with the given number of tags."
+    words = "the quick brown fox jumps over a lazy dog".split()
+    parts = []
+    for i in range(1, tags + 1):
+        parts.append(" ".join(rnd.choices(words, k=3)))
+        parts.append(rnd.choice(TAG_KINDS).format(i=i))
+    return "".join(parts)
@@ -0,0 +1,166 @@
+import asyncio, json, threading, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import httpx, pytest
+import variables
+from ollama_pool import OllamaPool, ollama_hosts, OLLAMA_KEEP_ALIVE
+from llm_trans import invoke_llm
+
+MODEL = "test-model"
+UNREACHABLE_HOST = "http://127.0.0.1:9"
+
+class FakeOllama:
+    """Local Ollama server with the endpoints the pool and ChatOllama use (/api/tags, /api/generate, /api/chat).
+    Records the warm-ups, the chat requests and the most chat requests it had at the same time.
+    """
+
+    def __init__(self, models: list, latency: float = 0.0):
+        self.models = models
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.warm_ups = []
+        self.chats = []
+        self.active = 0
+        self.max_active = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, body: dict):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self.send_json({"models": [{"name": model, "model": model} for model in fake.models]})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                if self.path == "/api/generate":
+                    fake.warm_ups.append(body)
+                    return self.send_json({"model": body["model"], "response": "", "done": True})
+                with fake.lock:
+                    fake.chats.append(body)
+                    fake.active += 1
+                    fake.max_active = max(fake.max_active, fake.active)
+                time.sleep(fake.latency)
+                with fake.lock:
+                    fake.active -= 1
+                self.send_json({"model": body["model"], "created_at": "2025-01-01T00:00:00Z", "done": True, "done_reason": "stop",
+                                "message": {"role": "assistant", "content": json.dumps({"translation": "Hallo", "comments": None})},
+                                "prompt_eval_count": 20, "eval_count": 5})
+
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def fake_ollama():
+    servers = []
+
+    def start(models: list = (MODEL,), latency: float = 0.0):
+        servers.append(FakeOllama(list(models), latency))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.close()
+
+async def chat(pool: OllamaPool, client: httpx.AsyncClient):
+    async with pool.host() as url:
+        response = await client.post(f"{url}/api/chat", json={"model": MODEL, "messages": []})
+        response.raise_for_status()
+        return url
+
+def test_ollama_hosts_setting():
+    assert ollama_hosts("http://a:11434/, http://b:11434 http://c:11434,") == ["http://a:11434", "http://b:11434", "http://c:11434"]
+    assert ollama_hosts("") == []
+
+def test_start_warms_up_and_checks_hosts(fake_ollama):
+    ready = fake_ollama()
+    without_model = fake_ollama(models=["other-model"])
+    pool = OllamaPool([ready.url, without_model.url, UNREACHABLE_HOST], MODEL, slots=2)
+    asyncio.run(pool.start())
+
+    assert [host.url for host in pool.hosts] == [ready.url, UNREACHABLE_HOST]
+    assert ready.warm_ups == [{"model": MODEL, "keep_alive": OLLAMA_KEEP_ALIVE}]
+    assert without_model.warm_ups == []
+    assert pool.hosts[0].available() and not pool.hosts[1].available()
+    assert pool.select().url == ready.url
+
+def test_routing_respects_slots(fake_ollama):
+    fast = fake_ollama(latency=0.05)
+    slow = fake_ollama(latency=0.2)
+    pool = OllamaPool([fast.url, slow.url], MODEL, slots=2)
+
+    async def run():
+        await pool.start()
+        async with httpx.AsyncClient() as client:
+            return await asyncio.gather(*(chat(pool, client) for _ in range(24)))
+
+    urls = asyncio.run(run())
+    assert fast.max_active <= 2 and slow.max_active <= 2
+    assert len(fast.chats) + len(slow.chats) == 24
+    # the queue of the pool gives the fast host the freed slots, the slow host doesn't collect a queue of its own
+    assert urls.count(fast.url) > urls.count(slow.url) > 0
+    assert all(host.outstanding == 0 for host in pool.hosts)
+
+def test_least_outstanding_host_is_selected(fake_ollama):
+    pool = OllamaPool([fake_ollama().url, fake_ollama().url], MODEL, slots=4)
+    pool.hosts[0].outstanding = 2
+    pool.hosts[1].outstanding = 1
+    assert pool.select() is pool.hosts[1]
+    pool.hosts[1].outstanding = 4
+    assert pool.select() is pool.hosts[0]
+    pool.hosts[0].outstanding = 4
+    assert pool.select() is None
+
+def test_failed_host_is_marked_down(fake_ollama):
+    healthy = fake_ollama()
+    pool = OllamaPool([UNREACHABLE_HOST, healthy.url], MODEL, slots=1)
+
+    async def run():
+        async with httpx.AsyncClient() as client:
+            # before start both hosts are available, the first request goes to the first host and fails
+            with pytest.raises(httpx.ConnectError):
+                async with pool.host() as url:
+                    assert url == UNREACHABLE_HOST
+                    await client.post(f"{url}/api/chat", json={})
+            return [await chat(pool, client) for _ in range(3)]
+
+    assert asyncio.run(run()) == [healthy.url] * 3
+    assert not pool.hosts[0].available()
+    assert pool.hosts[0].failed == 1 and pool.hosts[1].served == 3
+
+def test_llm_requests_go_through_the_pool(fake_ollama, monkeypatch):
+    hosts = [fake_ollama(latency=0.05), fake_ollama(latency=0.05)]
+    monkeypatch.setattr(variables, "selected_llm", "Ollama")
+    monkeypatch.setattr(variables, "ollama_model", MODEL)
+    monkeypatch.setitem(variables.trans_info, "ollama_pool", None)
+    pool = OllamaPool([host.url for host in hosts], MODEL, slots=1)
+
+    async def run():
+        await pool.start()
+        variables.trans_info["ollama_pool"] = pool
+        return await asyncio.gather(*(invoke_llm([("human", "Hello")]) for _ in range(4)))
+
+    responses = asyncio.run(run())
+    parsed, tokens = responses[0]
+    assert parsed.translation == "Hallo" and tokens == (20, 5)
+    assert [len(host.chats) for host in hosts] == [2, 2]
+    assert all(host.max_active == 1 for host in hosts)
+    assert all(chat["keep_alive"] == OLLAMA_KEEP_ALIVE for host in hosts for chat in host.chats)
@@ -0,0 +1,86 @@
+import random
+from conftest import TEST_DOCUMENT
+from reference_kernels import reference_lev_distance, reference_create_tag_dict, reference_restore_tags, document_sources, tagged_segment
+from segment import lev_distance, lev_distance_batch, create_tag_dict, restore_tags, transfer_tags, tag_codec
+
+def random_text(rnd: random.Random, length: int, alphabet: str = "abcde "):
+    return "".join(rnd.choice(alphabet) for _ in range(length))
+
+def edited(rnd: random.Random, text: str, edits: int):
+    "Returns the text with random substitutions, insertions and deletions."
+    for _ in range(edits):
+        position = rnd.randrange(len(text) + 1)
+        operation = rnd.choice("sid")
+        if operation == "s" and position < len(text):
+            text = text[:position] + rnd.choice("xyzé") + text[position + 1:]
+        elif operation == "d" and position < len(text):
+            text = text[:position] + text[position + 1:]
+        else:
+            text = text[:position] + rnd.choice("xyzé") + text[position:]
+    return text
+
+def test_lev_distance_matches_reference_on_document():
+    sources = [source for source in document_sources(TEST_DOCUMENT) if len(source) <= 80][:40]
+    for s1 in sources:
+        for s2 in sources:
+            assert lev_distance(s1, s2) == reference_lev_distance(s1, s2)
+
+def test_lev_distance_matches_reference_on_edits():
+    rnd = random.Random(3)
+    for _ in range(500):
+        # lengths around and above 64 cross the machine word size of other bit-parallel implementations
+        s1 = random_text(rnd, rnd.randrange(0, 150))
+        s2 = edited(rnd, s1, rnd.randrange(0, 20)) if rnd.random() < 0.7 else random_text(rnd, rnd.randrange(0, 150))
+        assert lev_distance(s1, s2) == reference_lev_distance(s1, s2)
+
+def test_lev_distance_bound():
+    rnd = random.Random(5)
+    for _ in range(500):
+        s1 = random_text(rnd, rnd.randrange(0, 90))
+        s2 = edited(rnd, s1, rnd.randrange(0, 15))
+        max_distance = rnd.randrange(0, 12)
+        assert lev_distance(s1, s2, max_distance) == min(reference_lev_distance(s1, s2), max_distance + 1)
+
+def test_lev_distance_batch_matches_reference():
+    rnd = random.Random(7)
+    for _ in range(40):
+        segment = random_text(rnd, rnd.randrange(0, 70))
+        candidates = [edited(rnd, segment, rnd.randrange(0, 12)) for _ in range(rnd.randrange(1, 30))] + [""]
+        expected = [reference_lev_distance(segment, candidate) for candidate in candidates]
+        assert lev_distance_batch(segment, candidates).tolist() == expected
+        max_distance = rnd.randrange(0, 10)
+        assert lev_distance_batch(segment, candidates, max_distance).tolist() == [min(distance, max_distance + 1) for distance in expected]
+    assert lev_distance_batch("abc", []).tolist() == []
+
+def test_tag_codec_matches_reference():
+    rnd = random.Random(11)
+    segments = document_sources(TEST_DOCUMENT, with_tags=True) + [tagged_segment(rnd, tags) for tags in (0, 1, 2, 12, 40) for _ in range(20)]
+    for segment in segments:
+        masked = create_tag_dict(segment)
+        assert masked == reference_create_tag_dict(segment)
+        assert restore_tags(*masked) == reference_restore_tags(*masked)
+
+def test_tag_codec_round_trip():
+    rnd = random.Random(13)
+    for tags in (1, 9, 10, 11, 120):
+        # tags without entities decode to themselves, restoring gives back the segment
+        segment = "".join(f"word {i} <ph id=\"{i}\"/>" if i % 2 else f"<bpt id=\"{i}\"/>word {i}<ept id=\"{i}\"/>" for i in range(1, tags + 1))
+        cleaned_text, tags_dict = tag_codec.mask(segment)
+        assert "<ph" not in cleaned_text and "<bpt" not in cleaned_text
+        assert tag_codec.restore(cleaned_text, tags_dict) == segment
+        # an engine may move the placeholders, each one still restores its own tag
+        placeholders = list(tags_dict)
+        rnd.shuffle(placeholders)
+        assert tag_codec.restore("".join(placeholders), tags_dict) == "".join(tags_dict[placeholder] for placeholder in placeholders)
+
+def test_restore_leaves_unknown_placeholders():
+    cleaned_text, tags_dict = create_tag_dict('a <ph id="1"/> b')
+    assert restore_tags(cleaned_text + " <UTAG7/>", tags_dict) == 'a <ph id="1"/> b <UTAG7/>'
+    assert restore_tags("no tags <UTAG1/>", {}) == "no tags <UTAG1/>"
+
+def test_transfer_tags_to_repetition():
+    _, from_tags = create_tag_dict('<bpt id="1" ctype="bold"/>Text<ept id="1"/>')
+    _, to_tags = create_tag_dict('<bpt id="4" ctype="bold"/>Text<ept id="4"/>')
+    translation = '<bpt id="1" ctype="bold"/>Texte<ept id="1"/>'
+    assert transfer_tags(translation, from_tags, to_tags) == '<bpt id="4" ctype="bold"/>Texte<ept id="4"/>'
+    assert transfer_tags(translation, from_tags, from_tags) == translation
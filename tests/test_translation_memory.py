@@ -0,0 +1,106 @@
+import random
+import pytest
+from segment import lev_distance_batch
+from translation_memory import TranslationMemory, PersistentTranslationMemory, fuzzy_percent
+
+def brute_force_lookup(units: list, segment: str, threshold: int = 80):
+    "Returns the best similarity above the threshold of a full scan with the unbounded edit distance (checked in test_segment.py)."
+    distances = lev_distance_batch(segment, [source for source, _ in units]).tolist()
+    similarities = [fuzzy_percent(segment, source, distance) for (source, _), distance in zip(units, distances)]
+    best_similarity = max(similarities, default=0)
+    return best_similarity if best_similarity > threshold else None
+
+def decoy_family(i: int):
+    """Returns a segment, decoys that share more n-grams with it than its best match (every adjacent word swap)
+    and the best match (three substitutions).
+    """
+    words = f"Unit {i} check the main hydraulic pump pressure and the oil level before starting the conveyor motor every morning".split()
+    segment = " ".join(words)
+    decoys = [" ".join(words[:j] + [words[j + 1], words[j]] + words[j + 2:]) + end for j in range(len(words) - 1) for end in ("", ".", "!")]
+    best = list(segment)
+    for position in (20, 55, 90):
+        best[position] = "#"
+    return segment, decoys, "".join(best)
+
+def templated_units(rnd: random.Random, count: int):
+    "Returns near-duplicate (source, target) units like the repetitive sentences of a manual."
+    templates = ["Press the {c} button on the {p} to {v} the {n}.", "Press the {c} button on the {p} to {v} the {n} within {x} seconds.",
+                 "Do not {v} the {n} while the {c} lamp on the {p} is lit.", "Check that the {n} is {v}ed before pressing the {c} button."]
+    units = {}
+    while len(units) < count:
+        source = rnd.choice(templates).format(c=rnd.choice(["red", "green", "blue", "yellow", "black"]), p=rnd.choice(["front panel", "rear panel", "control unit", "top cover"]),
+                                              v=rnd.choice(["start", "stop", "reset", "open", "lock"]), n=rnd.choice(["pump", "valve", "motor", "fan", "door"]), x=rnd.randint(1, 60))
+        units[source] = source.upper()
+    return list(units.items())
+
+def edited(rnd: random.Random, text: str, edits: int):
+    for _ in range(edits):
+        position = rnd.randrange(len(text))
+        operation = rnd.choice("sid")
+        if operation == "s":
+            text = text[:position] + rnd.choice("abcdefgh ") + text[position + 1:]
+        elif operation == "d":
+            text = text[:position] + text[position + 1:]
+        else:
+            text = text[:position] + rnd.choice("abcdefgh ") + text[position:]
+    return text
+
+@pytest.fixture(params=["memory", "store"])
+def new_tm(request, tmp_path):
+    "Returns a function that fills an in-memory or a SQLite translation memory with units."
+    stores = []
+
+    def fill(units: list):
+        if request.param == "memory":
+            tm = TranslationMemory()
+        else:
+            tm = PersistentTranslationMemory(str(tmp_path / f"tm{len(stores)}.sqlite"))
+            stores.append(tm)
+        for source, target in units:
+            tm.add(source, target)
+        return tm
+
+    yield fill
+    for tm in stores:
+        tm.close()
+
+def lookup_similarity(tm, segment: str):
+    match = tm.lookup(segment)
+    return match[2] if match else None
+
+def test_lookup_beats_decoys(new_tm):
+    units = []
+    segments = []
+    for i in range(5):
+        segment, decoys, best = decoy_family(i)
+        segments.append(segment)
+        units += [(source, source.upper()) for source in decoys + [best]]
+    tm = new_tm(units)
+
+    for segment in segments:
+        source, target, similarity = tm.lookup(segment)
+        assert similarity == brute_force_lookup(units, segment)
+        assert source.count("#") == 3 and target == source.upper()
+
+def test_lookup_matches_brute_force(new_tm):
+    rnd = random.Random(17)
+    units = templated_units(rnd, 600)
+    tm = new_tm(units)
+
+    for _ in range(60):
+        segment = edited(rnd, rnd.choice(units)[0], rnd.randint(1, 8))
+        assert lookup_similarity(tm, segment) == brute_force_lookup(units, segment)
+
+def test_store_lookup_with_common_grams(tmp_path, monkeypatch):
+    # a budget smaller than any posting list, the store still queries enough grams for every unit above the threshold
+    monkeypatch.setattr("translation_memory.RARE_GRAM_BUDGET", 1)
+    rnd = random.Random(19)
+    units = templated_units(rnd, 300)
+    tm = PersistentTranslationMemory(str(tmp_path / "tm.sqlite"))
+    for source, target in units:
+        tm.add(source, target)
+
+    for _ in range(40):
+        segment = edited(rnd, rnd.choice(units)[0], rnd.randint(1, 8))
+        assert lookup_similarity(tm, segment) == brute_force_lookup(units, segment)
+    tm.close()